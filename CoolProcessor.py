@@ -6,6 +6,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 
 import random 
+import instrumentation
 
 def extract_filename(file_path):
     # Get the file name from the full path and remove the .cool extension
@@ -66,19 +67,21 @@ class CoolProcessor:
             Returns a list of interactions for the specified chromosome, with bin indices translated to genomic loci and counts summed.
     """
     def __init__(self, pathToCoolFile, cellName=None):
-        if type(pathToCoolFile)==str:
-            self.c = cooler.Cooler(pathToCoolFile)
-            self.originalPath = pathToCoolFile
-        else:
-            self.c=pathToCoolFile
-            self.originalPath = ""
         if cellName is None:
             cellName = extract_filename(pathToCoolFile)
         self.cellName = cellName
+
+        with instrumentation.span("CoolProcessor.init", cell=cellName):
+            if type(pathToCoolFile)==str:
+                self.c = cooler.Cooler(pathToCoolFile)
+                self.originalPath = pathToCoolFile
+            else:
+                self.c=pathToCoolFile
+                self.originalPath = ""
         
-        self.chromNames = set(self.c.chromnames)
-        self.coolMatrix = self.c.matrix(balance=False, sparse=True)
-        self.bins = self.c.bins()[:]
+            self.chromNames = set(self.c.chromnames)
+            self.coolMatrix = self.c.matrix(balance=False, sparse=True)
+            self.bins = self.c.bins()[:]
 
         self.chrInteractions = {ch: None for ch in self.chromNames}
         self.translateBinToLocus = {ch: None for ch in self.chromNames}
@@ -89,7 +92,9 @@ class CoolProcessor:
     
 
     def __setInteractions(self, ch):
-        pixels = self.coolMatrix.fetch(ch)
+        with instrumentation.span("CoolProcessor.fetch", cell=self.cellName, chr=ch) as s:
+            pixels = self.coolMatrix.fetch(ch)
+            s.set(pixels=len(pixels.data))
         rows, cols, counts = pixels.row, pixels.col, pixels.data
 
         # Directly create integer tuples without redundant conversions
@@ -128,7 +133,8 @@ class CoolProcessor:
         chunksize = 10000000  # You can adjust this based on your file size and memory
 
         # Create new cooler file with reduced resolution
-        cooler.coarsen_cooler(self.originalPath, fn, factor=coarsen_factor, chunksize=chunksize)
+        with instrumentation.span("CoolProcessor.reduceResolution", cell=self.cellName, k=k):
+            cooler.coarsen_cooler(self.originalPath, fn, factor=coarsen_factor, chunksize=chunksize)
         return CoolProcessor(fn, cellName=self.cellName)
 
 
@@ -154,6 +160,7 @@ class CoolProcessor:
     def getAllInteractionsWithLoci(self, ch):
         #Returns list of links [aaa, bbb, count] where aaa and bbb are loci
         if not self.allChrJsonInteractions[ch]:
-            self.__setAllInteractionsWithLoci(ch)
+            with instrumentation.span("CoolProcessor.interactionsWithLoci", cell=self.cellName, chr=ch) as s:
+                s.set(links=len(self.__setAllInteractionsWithLoci(ch)))
         return self.allChrJsonInteractions[ch]
     
\ No newline at end of file
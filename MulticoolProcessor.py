@@ -1,6 +1,7 @@
 import h5py
 import cooler
 from CoolProcessor import CoolProcessor
+import instrumentation
 
 class MulticoolProcessor:
     """
@@ -58,7 +59,8 @@ class MulticoolProcessor:
             A CoolProcessor object initialized with the cell's data.
         """
         cool_uri = f"{self.fn}::/cells/{cellName}"
-        return CoolProcessor(cool_uri, cellName)
+        with instrumentation.span("MulticoolProcessor.readCell", cell=cellName):
+            return CoolProcessor(cool_uri, cellName)
 
     def getCoolObject(self, cellName="hicBuildMatrix_MATRIX_on_data_16179_and_data_16116"):
         """
@@ -0,0 +1,282 @@
+import pickle
+import os
+import time
+from itertools import chain
+import numpy as np
+import pandas as pd
+import instrumentation
+
+from createPairwiseSimilarities import countCliquePairs, isEligibleClique, savePairwiseSimilarities
+
+
+MINHASH_PRIME = (1 << 31) - 1 #Mersenne prime; keeps a*x+b inside uint64 for clique ids < 2^31
+EMPTY_SIGNATURE = np.uint64(MINHASH_PRIME) #Larger than any hash value, marks cells without shared cliques
+CANDIDATE_FACTOR = 0.25 #Default candidates per cell are CANDIDATE_FACTOR*K*sqrt(cells), see defaultCandidatesPerCell
+MIN_BUCKET = 8 #Smallest default maxBucket, see defaultMaxBucket
+
+
+def getSharedCliqueSets(data, motifName, motifLength):
+    """
+    Returns {cellID: set(cliqueIndex)} restricted to eligible cliques found in at least two cells.
+    Cliques present in a single cell never contribute to pair frequencies, so they are left out of the sketches.
+    """
+    cliqueIndex = {}
+    for clique, listOfCells in data["clique_cells"][motifName].items():
+        if len(listOfCells) <= 1 or not isEligibleClique(clique, motifLength):
+            continue
+        cliqueIndex[clique] = len(cliqueIndex)
+
+    cellSets = {}
+    for cellID in data["cell_IDs"]:
+        cliques = data["cell_cliques"][motifName].get(cellID, set())
+        cellSets[cellID] = {cliqueIndex[clique] for clique in cliques if clique in cliqueIndex}
+    return cellSets
+
+
+def minhashSignatures(cellSets, cellIDs, numPerm=128, seed=0):
+    """
+    Computes a MinHash signature (numPerm universal hashes (a*x+b) mod p) for each cell's clique set.
+    Returns a (len(cellIDs), numPerm) uint64 matrix; rows of empty cells are filled with EMPTY_SIGNATURE.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MINHASH_PRIME, size=numPerm, dtype=np.uint64)
+    b = rng.integers(0, MINHASH_PRIME, size=numPerm, dtype=np.uint64)
+
+    signatures = np.full((len(cellIDs), numPerm), EMPTY_SIGNATURE, dtype=np.uint64)
+    for row, cellID in enumerate(cellIDs):
+        if not cellSets[cellID]:
+            continue
+        ids = np.fromiter(cellSets[cellID], dtype=np.uint64, count=len(cellSets[cellID]))
+        hashes = (a[:, None]*ids[None, :] + b[:, None]) % np.uint64(MINHASH_PRIME)
+        signatures[row] = hashes.min(axis=1)
+    return signatures
+
+
+def defaultCandidatesPerCell(numCells, K=5):
+    """
+    Candidates kept per cell, ceil(CANDIDATE_FACTOR*K*sqrt(numCells)). The MinHash estimate has the same noise at any
+    size, while the number of cells it must tell a cell's top-K neighbors apart from grows, so the candidates grow
+    too, but slower than the cells: the candidate pairs grow as numCells**1.5 instead of numCells**2.
+    """
+    return int(min(max(numCells - 1, 1), max(K, np.ceil(CANDIDATE_FACTOR*K*np.sqrt(numCells)))))
+
+
+def defaultMaxBucket(numCells):
+    #Largest bucket expanded in full, and 2x the window of larger buckets (see lshBandPairs); grows as log2(numCells)
+    return int(max(MIN_BUCKET, np.ceil(np.log2(max(numCells, 2)))))
+
+
+def lshBandPairs(signatures, bandStart, bandStop, rows, maxBucket):
+    """
+    Candidate pair codes (row1*numCells + row2, row1 < row2) of the bands bandStart..bandStop-1, with repeats.
+    Buckets of up to maxBucket rows give all their pairs. Larger buckets come from cliques shared by many cells;
+    instead of all their pairs, their rows are ordered by the signature entries that follow the band, and each row is
+    paired with the maxBucket//2 rows on either side of it, so rows agreeing on more entries are paired first.
+    Rows with EMPTY_SIGNATURE never collide.
+    """
+    numCells, numPerm = signatures.shape
+    nonEmpty = np.flatnonzero(signatures[:, 0] != EMPTY_SIGNATURE)
+    bandCount = bandStop - bandStart
+    present = signatures[nonEmpty]
+
+    #One bucket key per (band, cell): band rows folded into a single uint64 (wrapping multiply-add)
+    keys = np.zeros((bandCount, len(nonEmpty)), dtype=np.uint64)
+    for row in range(rows):
+        columns = np.arange(bandStart, bandStop)*rows + row
+        keys = keys*np.uint64(MINHASH_PRIME) + present[:, columns].T
+    nextColumns = [present[:, (np.arange(bandStart, bandStop) + shift)*rows % numPerm].T.ravel() for shift in (2, 1)]
+    keys = keys.ravel()
+    bandOf = np.repeat(np.arange(bandCount), len(nonEmpty))
+    cellOf = np.tile(nonEmpty, bandCount)
+
+    order = np.lexsort((*nextColumns, keys, bandOf))
+    sortedKeys, sortedBands, cellOrder = keys[order], bandOf[order], cellOf[order]
+    newBucket = np.r_[True, (sortedKeys[1:] != sortedKeys[:-1]) | (sortedBands[1:] != sortedBands[:-1])]
+    starts = np.flatnonzero(newBucket)
+    sizes = np.diff(np.r_[starts, len(order)])
+
+    pairCodes = []
+    for size in np.unique(sizes[(sizes >= 2) & (sizes <= maxBucket)]):
+        members = cellOrder[starts[sizes == size][:, None] + np.arange(size)]
+        i, j = np.triu_indices(size, 1)
+        row1, row2 = members[:, i].ravel(), members[:, j].ravel()
+        pairCodes.append(np.minimum(row1, row2)*numCells + np.maximum(row1, row2))
+
+    bucketOf = np.cumsum(newBucket) - 1
+    inLarge = np.flatnonzero(sizes[bucketOf] > maxBucket)
+    for distance in range(1, maxBucket//2 + 1):
+        first = inLarge[inLarge + distance < len(order)]
+        first = first[bucketOf[first + distance] == bucketOf[first]]
+        row1, row2 = cellOrder[first], cellOrder[first + distance]
+        pairCodes.append(np.minimum(row1, row2)*numCells + np.maximum(row1, row2))
+
+    if not pairCodes:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(pairCodes).astype(np.int64)
+
+
+def signatureAgreement(signatures, row1, row2, chunkRows=1 << 16):
+    #Fraction of equal signature entries of each pair of rows, the MinHash estimate of their Jaccard similarity
+    agreement = np.empty(len(row1))
+    for start in range(0, len(row1), chunkRows):
+        stop = start + chunkRows
+        agreement[start:stop] = (signatures[row1[start:stop]] == signatures[row2[start:stop]]).mean(axis=1)
+    return agreement
+
+
+def topPairsPerCell(row1, row2, score, candidatesPerCell):
+    #Mask of the pairs that are among the candidatesPerCell best scoring pairs of either of their rows
+    source = np.r_[row1, row2]
+    pairIndex = np.r_[np.arange(len(row1)), np.arange(len(row1))]
+    order = np.lexsort((-np.r_[score, score], source))
+    sortedSource = source[order]
+    starts = np.flatnonzero(np.r_[True, sortedSource[1:] != sortedSource[:-1]])
+    rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    keep = np.zeros(len(row1), dtype=bool)
+    keep[pairIndex[order][rank < candidatesPerCell]] = True
+    return keep
+
+
+def lshCandidatePairs(signatures, setSizes, K=5, bands=128, maxBucket=None, candidatesPerCell=None, bandBatch=16):
+    """
+    Returns (row1, row2) arrays, row1 < row2, of the signature rows worth counting exactly.
+    Pairs colliding in at least one band (see lshBandPairs) are scored by their estimated number of shared cliques,
+    J/(1+J)*(|A|+|B|) with J the signature agreement, and only each row's candidatesPerCell best pairs are kept;
+    a pair is kept if it ranks high for either row. By default candidatesPerCell and maxBucket grow with the number
+    of rows (defaultCandidatesPerCell, defaultMaxBucket). Bands are processed in batches of bandBatch and pruned
+    after each batch, so memory stays proportional to the number of rows times candidatesPerCell.
+    """
+    numCells, numPerm = signatures.shape
+    if numPerm % bands != 0:
+        raise ValueError(f"numPerm ({numPerm}) must be divisible by bands ({bands})")
+    rows = numPerm // bands
+    if candidatesPerCell is None:
+        candidatesPerCell = defaultCandidatesPerCell(numCells, K)
+    if maxBucket is None:
+        maxBucket = defaultMaxBucket(numCells)
+    setSizes = np.asarray(setSizes)
+
+    codes, scores = np.empty(0, dtype=np.int64), np.empty(0)
+    for bandStart in range(0, bands, bandBatch):
+        newCodes = np.sort(lshBandPairs(signatures, bandStart, min(bandStart + bandBatch, bands), rows, maxBucket))
+        newCodes = newCodes[np.r_[True, newCodes[1:] != newCodes[:-1]]]
+        newCodes = newCodes[~np.isin(newCodes, codes, assume_unique=True)]
+        row1, row2 = newCodes // numCells, newCodes % numCells
+        jaccard = signatureAgreement(signatures, row1, row2)
+        codes = np.r_[codes, newCodes]
+        scores = np.r_[scores, jaccard/(1 + jaccard)*(setSizes[row1] + setSizes[row2])]
+        keep = topPairsPerCell(codes // numCells, codes % numCells, scores, candidatesPerCell)
+        codes, scores = codes[keep], scores[keep]
+    return codes // numCells, codes % numCells
+
+
+def approximateCliquePairs(data, motifName, motifLength, K=5, numPerm=128, bands=128, maxBucket=None, candidatesPerCell=None, seed=0):
+    """
+    Approximate counterpart of countCliquePairs. Candidate pairs come from MinHash/LSH over each
+    cell's clique set (see lshCandidatePairs), and exact co-occurrence counts are computed only for those candidates.
+    K is the number of neighbors used downstream (runSCHiCRank.K); the candidates kept per cell are derived from it.
+    Returns dict {(cell1, cell2): frequency} with cell1 < cell2 and frequency > 0.
+    """
+    cellIDs = data["cell_IDs"]
+    with instrumentation.span("approximateCliquePairs.minhash", chr=data["chr"], motif=f"{motifName}-{motifLength}"):
+        cellSets = getSharedCliqueSets(data, motifName, motifLength)
+        signatures = minhashSignatures(cellSets, cellIDs, numPerm=numPerm, seed=seed)
+
+    with instrumentation.span("approximateCliquePairs.candidates", chr=data["chr"], motif=f"{motifName}-{motifLength}") as s:
+        cellPairFrequencies = dict()
+        setSizes = [len(cellSets[cellID]) for cellID in cellIDs]
+        row1, row2 = lshCandidatePairs(signatures, setSizes, K=K, bands=bands, maxBucket=maxBucket,
+                                       candidatesPerCell=candidatesPerCell)
+        cellIDs = np.asarray(cellIDs)
+        cell1, cell2 = cellIDs[row1], cellIDs[row2]
+        for cell1, cell2 in zip(np.minimum(cell1, cell2).tolist(), np.maximum(cell1, cell2).tolist()):
+            frequency = len(cellSets[cell1] & cellSets[cell2])
+            if frequency > 0:
+                cellPairFrequencies[(cell1, cell2)] = frequency
+        s.set(candidates=len(row1), pairs=len(cellPairFrequencies))
+    return cellPairFrequencies
+
+
+def callApproximatePairwiseSimilarities(filename, K=5, numPerm=128, bands=128, maxBucket=None, candidatesPerCell=None, seed=0):
+    #Same output layout as callPairwiseSimilarites, saved under approximatePairwiseSimilarities/
+    with open(filename, "rb") as f:
+        data = pickle.load(f) #Read clique data
+    typ = data["type"]
+
+    for motifName in data["clique_cells"].keys():
+        for motifLength in ["alllengths", "long"]:
+            resultDir = f"approximatePairwiseSimilarities/{motifName}-{motifLength}/"
+            os.makedirs(resultDir, exist_ok=True)
+            resultFn = f'{resultDir}pairwiseSimilarities-{typ}-{data["chr"]}-{data["resolution"]}-{motifName}-{motifLength}.csv'
+            print(f"Processing {resultFn}")
+            cellPairFrequencies = approximateCliquePairs(data, motifName, motifLength, K=K, numPerm=numPerm, bands=bands,
+                                                         maxBucket=maxBucket, candidatesPerCell=candidatesPerCell, seed=seed)
+            savePairwiseSimilarities(resultFn, cellPairFrequencies, data)
+
+
+def readPairFrequencies(csvFn):
+    #Reads {(cell1, cell2): frequency} from a pairwise similarity CSV (e.g. the files in K4_imputed_long_3.0)
+    df = pd.read_csv(csvFn, usecols=["Item 1", "Item 2", "Frequency"])
+    cell1 = df["Item 1"].to_numpy()
+    cell2 = df["Item 2"].to_numpy()
+    return {(int(min(a, b)), int(max(a, b))): int(freq) for a, b, freq in zip(cell1, cell2, df["Frequency"].to_numpy())}
+
+
+def topNeighbors(cellPairFrequencies, K=5):
+    #For each cell, the set of K neighbors with the highest frequency (ties broken by cell index)
+    pairs = np.fromiter(chain.from_iterable(cellPairFrequencies.keys()), dtype=np.int64, count=2*len(cellPairFrequencies)).reshape(-1, 2)
+    frequencies = np.fromiter(cellPairFrequencies.values(), dtype=np.int64, count=len(cellPairFrequencies))
+    source, neighbor = np.r_[pairs[:, 0], pairs[:, 1]], np.r_[pairs[:, 1], pairs[:, 0]]
+    order = np.lexsort((neighbor, -np.r_[frequencies, frequencies], source))
+    source, neighbor = source[order], neighbor[order]
+    starts = np.flatnonzero(np.r_[True, source[1:] != source[:-1]])
+    rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    top = {}
+    for cell, n in zip(source[rank < K].tolist(), neighbor[rank < K].tolist()):
+        top.setdefault(cell, set()).add(n)
+    return top
+
+
+def neighborRecall(exactPairFrequencies, approxPairFrequencies, K=5):
+    """
+    Mean fraction of each cell's exact top-K neighbors that are also found by the approximate path.
+    This is the quantity that matters downstream, as run_pagerank_filter only uses the top-K neighbors.
+    """
+    exactTop = topNeighbors(exactPairFrequencies, K)
+    approxTop = topNeighbors(approxPairFrequencies, K)
+    recalls = [len(neighbors & approxTop.get(cell, set()))/len(neighbors) for cell, neighbors in exactTop.items()]
+    return sum(recalls)/len(recalls) if recalls else 1.0
+
+
+def reportRecall(cliquesFn, motifName="K4", motifLength="long", exactCsv=None, K=5, numPerm=128, bands=128,
+                 maxBucket=None, candidatesPerCell=None, seed=0):
+    """
+    Prints top-K neighbor recall, candidate ratio (approximate pairs / exact pairs) and speedup of the
+    approximate path against the exact one. The exact pairs are counted from cliquesFn, or read from exactCsv
+    when given (e.g. K4_imputed_long_3.0/imputedCellLinks-chr18-100000-3.0_longLinks_L1freqs.csv);
+    the speedup is only reported when they are counted.
+    """
+    with open(cliquesFn, "rb") as f:
+        data = pickle.load(f)
+    exactSeconds = None
+    if exactCsv is None:
+        start = time.perf_counter()
+        exactPairs = countCliquePairs(data, motifName, motifLength)
+        exactSeconds = time.perf_counter() - start
+    else:
+        exactPairs = readPairFrequencies(exactCsv)
+    start = time.perf_counter()
+    approxPairs = approximateCliquePairs(data, motifName, motifLength, K=K, numPerm=numPerm, bands=bands, maxBucket=maxBucket,
+                                         candidatesPerCell=candidatesPerCell, seed=seed)
+    approxSeconds = time.perf_counter() - start
+    recall = neighborRecall(exactPairs, approxPairs, K)
+    ratio = len(approxPairs)/len(exactPairs) if exactPairs else 1.0
+    speedup = f", speedup {exactSeconds/approxSeconds:.2f}x" if exactSeconds is not None else ""
+    print(f"{data['chr']} {motifName}-{motifLength}: top-{K} recall {recall:.4f}, candidate ratio {ratio:.3f} "
+          f"({len(approxPairs)} of {len(exactPairs)} exact pairs){speedup}")
+    return recall
+
+
+if __name__ == "__main__":
+
+    reportRecall("base100k-chr18-100000-cliques.pkl", motifName="K4", motifLength="long")
@@ -0,0 +1,314 @@
+import os
+import sys
+import json
+import time
+import queue
+import glob
+import shutil
+import logging
+import platform
+import subprocess
+import contextlib
+import multiprocessing
+import numpy as np
+
+from createSyntheticScool import create_synthetic_scool
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+POSTFIX = "bench"
+STAGE_NAMES = ["process_cells", "createCliquePickles", "callPairwiseSimilarites", "process_cliques", "run_pagerank_filter"]
+POLL_S = 1.0 # Interval for checking whether a stage process is still alive
+
+
+def _peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def _clique_fns(params):
+    return [f"{POSTFIX}-{ch}-{params['resolution']}-cliques.pkl" for ch in params["chromosomes"]]
+
+
+# Stages: each runs in the benchmark working directory and returns counts used for throughput
+def stage_process_cells(params):
+    from processOriginalCoolDataset import process_cells
+    process_cells(cellCount=None, k=1, chromosomes=params["chromosomes"], fn=params["scool"],
+                  fnResolution=params["resolution"], postfix=POSTFIX)
+    return {"cells": params["cellCount"]}
+
+def stage_clique_pickles(params):
+    from createCliqueDatafiles import createCliquePickles
+    cliques = 0
+    for ch, resFn in zip(params["chromosomes"], _clique_fns(params)):
+        resObj = createCliquePickles(f"{POSTFIX}-{ch}-{params['resolution']}.pkl", resFn)
+        cliques += sum(len(s) for byCell in resObj["cell_cliques"].values() for s in byCell.values())
+    return {"cells": params["cellCount"], "cliques": cliques}
+
+def stage_pairwise_similarities(params):
+    from createPairwiseSimilarities import callPairwiseSimilarites
+    for fn in _clique_fns(params):
+        callPairwiseSimilarites(fn)
+    return {"cells": params["cellCount"]}
+
+def count_pairwise_rows(params):
+    # Counted after the stage is timed: data rows of all CSV files written by callPairwiseSimilarites
+    pairs = 0
+    for fn in glob.glob("pairwiseSimilarities/*/*.csv"):
+        with open(fn) as f:
+            pairs += sum(1 for _ in f) - 1
+    return {"pairs": pairs}
+
+def stage_clique_counts(params):
+    from createCliqueCountsOverview import process_cliques
+    for ch, fn in zip(params["chromosomes"], _clique_fns(params)):
+        process_cliques(fn, f"all_cliques_data_{ch}_{POSTFIX}.csv")
+    return {"cells": params["cellCount"]}
+
+def stage_pagerank_filter(params):
+    from runSCHiCRank import run_pagerank_filter
+    run_pagerank_filter(f"pairwiseSimilarities/{params['motif']}/", label=POSTFIX, plots=False)
+    return {"cells": params["cellCount"]}
+
+STAGES = {
+    "process_cells": (stage_process_cells, None),
+    "createCliquePickles": (stage_clique_pickles, None),
+    "callPairwiseSimilarites": (stage_pairwise_similarities, count_pairwise_rows),
+    "process_cliques": (stage_clique_counts, None),
+    "run_pagerank_filter": (stage_pagerank_filter, None),
+}
+
+
+def _run_stage(stage, workDir, params, resultQueue):
+    # Runs in a fresh process, so peak RSS belongs to this stage only
+    os.chdir(workDir)
+    sys.path.insert(0, REPO_DIR)
+    logging.basicConfig(level=logging.WARNING) # Silences the per cell logging.info calls
+    runFn, countFn = STAGES[stage]
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            counts = runFn(params)
+            wall = time.perf_counter() - start
+            if countFn is not None:
+                counts.update(countFn(params))
+        resultQueue.put({"wall_s": wall, "peak_rss_mb": _peak_rss_mb(), "counts": counts})
+    except Exception as e:
+        resultQueue.put({"error": repr(e)})
+
+def run_stage(stage, workDir, params, timeout=None):
+    """
+    Runs one stage in a fresh process. Returns {"wall_s", "peak_rss_mb", "counts", "throughput"}, or {"error", "exitcode"}
+    if the stage raised, the process died without a result (e.g. killed when out of memory) or timeout seconds passed.
+    """
+    # spawn: no memory inherited from the benchmark process
+    context = multiprocessing.get_context("spawn")
+    resultQueue = context.Queue()
+    process = context.Process(target=_run_stage, args=(stage, workDir, params, resultQueue))
+    start = time.perf_counter()
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = resultQueue.get(timeout=POLL_S)
+        except queue.Empty:
+            if not process.is_alive():
+                # The result may have been queued just before the process exited
+                try:
+                    result = resultQueue.get(timeout=POLL_S)
+                except queue.Empty:
+                    result = {"error": f"Stage process exited with code {process.exitcode} without a result"}
+            elif timeout is not None and time.perf_counter() - start > timeout:
+                process.kill()
+                result = {"error": f"Stage timed out after {timeout} s"}
+    process.join()
+    if "error" in result:
+        result["exitcode"] = process.exitcode
+        return result
+    result["throughput"] = {f"{name}_per_s": count / result["wall_s"] for name, count in result["counts"].items() if result["wall_s"] > 0}
+    return result
+
+
+def benchmark_dataset(workDir, cellCount, contactsPerCell, resolution, chromosomeCount, motif="K4-alllengths", seed=0, stageTimeout=None):
+    """
+    Generates a synthetic dataset in workDir and runs all pipeline stages on it in order.
+    Returns {"cells", "stages": {stage: {"wall_s", "peak_rss_mb", "counts", "throughput"}}}.
+    A failed stage is recorded as {"error", "exitcode"} and the stages after it as {"skipped": stage}.
+    """
+    # Start from an empty directory, cached files of a previous run (e.g. full_neighbor_map.pkl) would skew timings
+    if os.path.exists(workDir):
+        shutil.rmtree(workDir)
+    os.makedirs(workDir)
+    cwd = os.getcwd()
+    os.chdir(workDir)
+    try:
+        info = create_synthetic_scool("synthetic.scool", cellCount=cellCount, contactsPerCell=contactsPerCell,
+                                      resolution=resolution, chromosomeCount=chromosomeCount, seed=seed,
+                                      cellTypeFn="sourceData/nagano_assoziated_cell_types.txt", metaFn="cellAndPhaseInfo.pkl")
+    finally:
+        os.chdir(cwd)
+
+    params = {"scool": "synthetic.scool", "cellCount": cellCount, "resolution": resolution,
+              "chromosomes": info["chromosomes"], "motif": motif}
+    stages = {}
+    failed = None
+    for stage in STAGE_NAMES:
+        if failed is not None:
+            stages[stage] = {"skipped": failed} # Later stages read the outputs of the failed one
+            continue
+        stages[stage] = run_stage(stage, os.path.abspath(workDir), params, timeout=stageTimeout)
+        if "error" in stages[stage]:
+            failed = stage
+            print(f"{cellCount} cells, {stage}: failed, {stages[stage]['error']}")
+        else:
+            print(f"{cellCount} cells, {stage}: {stages[stage]['wall_s']:.2f} s, {stages[stage]['peak_rss_mb']:.0f} MB")
+    return {"cells": cellCount, "stages": stages}
+
+
+def scaling_curves(runs):
+    """
+    Collects per stage wall time and peak RSS over cell counts and fits the scaling exponent,
+    i.e. the slope of log(wall time) over log(cells). Failed or skipped stages are left out.
+    """
+    curves = {}
+    for stage in STAGE_NAMES:
+        done = [run for run in runs if "wall_s" in run["stages"][stage]]
+        cells = [run["cells"] for run in done]
+        walls = [run["stages"][stage]["wall_s"] for run in done]
+        curve = {"cells": cells, "wall_s": walls, "peak_rss_mb": [run["stages"][stage]["peak_rss_mb"] for run in done]}
+        if len(cells) > 1 and min(walls) > 0:
+            curve["exponent"] = float(np.polyfit(np.log(cells), np.log(walls), 1)[0])
+        curves[stage] = curve
+    return curves
+
+
+def environment_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "cpu_count": os.cpu_count(), "git_commit": commit}
+
+
+def run_benchmark(cellCounts=[50, 100, 200, 400],
+                  contactsPerCell=4000,
+                  resolution=100000,
+                  chromosomeCount=4,
+                  motif="K4-alllengths",
+                  workRoot="benchmarkData",
+                  resFn="benchmark_results.json",
+                  seed=0,
+                  stageTimeout=None):
+    """
+    Runs the whole pipeline (process_cells, createCliquePickles, callPairwiseSimilarites, process_cliques,
+    run_pagerank_filter) on synthetic datasets of increasing cell count and saves wall time, peak RSS
+    and throughput of every stage, together with scaling curves, as JSON to resFn.
+    Each dataset is generated and processed in its own subdirectory of workRoot.
+    Stages that fail, die (e.g. out of memory) or run longer than stageTimeout seconds are recorded with their error.
+    """
+    config = {"cellCounts": list(cellCounts), "contactsPerCell": contactsPerCell, "resolution": resolution,
+              "chromosomeCount": chromosomeCount, "motif": motif, "seed": seed, "stageTimeout": stageTimeout}
+    runs = []
+    for cellCount in cellCounts:
+        workDir = os.path.join(workRoot, f"cells{cellCount}")
+        runs.append(benchmark_dataset(workDir, cellCount, contactsPerCell, resolution, chromosomeCount, motif=motif, seed=seed,
+                                      stageTimeout=stageTimeout))
+
+    results = {"config": config, "environment": environment_info(), "runs": runs, "scaling": scaling_curves(runs)}
+    with open(resFn, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Benchmark results saved to {resFn}")
+    return results
+
+
+def compare_benchmarks(baseFn, newFn):
+    """
+    Prints the speedup (base wall time / new wall time) and peak RSS change of every stage
+    for cell counts present in both benchmark JSON files.
+    """
+    with open(baseFn) as f:
+        base = {run["cells"]: run for run in json.load(f)["runs"]}
+    with open(newFn) as f:
+        new = {run["cells"]: run for run in json.load(f)["runs"]}
+    for cells in sorted(set(base) & set(new)):
+        for stage in STAGE_NAMES:
+            b, n = base[cells]["stages"][stage], new[cells]["stages"][stage]
+            if "wall_s" not in b or "wall_s" not in n:
+                print(f"{cells:>7} cells {stage:<25} {b.get('error', b.get('skipped', 'ok'))} -> {n.get('error', n.get('skipped', 'ok'))}")
+                continue
+            speedup = b["wall_s"] / n["wall_s"] if n["wall_s"] > 0 else float("inf")
+            print(f"{cells:>7} cells {stage:<25} {b['wall_s']:9.2f} s -> {n['wall_s']:9.2f} s  "
+                  f"x{speedup:5.2f}  RSS {b['peak_rss_mb']:.0f} -> {n['peak_rss_mb']:.0f} MB")
+
+
+# Weighted vs unweighted PageRank filter on an existing pairwise similarity directory
+WEIGHTED_CONFIGS = [
+    {"k": 5, "weighted": False, "weight_norm": None}, # Baseline
+    {"k": 3, "weighted": True, "weight_norm": None},
+    {"k": 4, "weighted": True, "weight_norm": None},
+    {"k": 5, "weighted": True, "weight_norm": None},
+    {"k": 3, "weighted": True, "weight_norm": "coverage"},
+    {"k": 4, "weighted": True, "weight_norm": "coverage"},
+]
+
+def phase_purity(result):
+    """
+    Size weighted mean over filter iterations of the fraction of the most common phase among the cells removed
+    in that iteration (the final active cells form the last group). 1.0 means every step removes cells of one phase.
+    """
+    majority = result.groupby("Iteration")["Phase"].agg(lambda phases: phases.value_counts().iloc[0])
+    return float(majority.sum() / len(result))
+
+def knn_phase_purity(neighbor_map, cells, cell_phases, k=5):
+    # Fraction of top-k neighbor edges among `cells` that connect cells of the same phase, over all chromosomes
+    cells = set(cells)
+    same = total = 0
+    for neighbor_dict in neighbor_map.values():
+        for cell in cells:
+            neighbors = [n for n, _ in neighbor_dict.get(cell, []) if n in cells][:k]
+            same += sum(cell_phases[n] == cell_phases[cell] for n in neighbors)
+            total += len(neighbors)
+    return same / total if total else float("nan")
+
+def compare_weighted_filter(input_dir="K4_imputed_long_3.0", configs=WEIGHTED_CONFIGS, resFn="weighted_pagerank_results.json", repeats=1):
+    """
+    Runs run_pagerank_filter on input_dir for each config of (k, weighted, weight_norm) and compares it with the
+    first config (the unweighted K=5 baseline): wall time (best of `repeats`, neighbor map loading excluded),
+    iterations, retained cells, phase_purity of the removal steps and knn_phase_purity (k=5) of the retained cells.
+    Saves the results as JSON to resFn.
+    """
+    from runSCHiCRank import build_full_neighbor_map, load_cell_phases, run_pagerank_filter
+    neighbor_map = build_full_neighbor_map(input_dir)
+    cell_phases = load_cell_phases()
+
+    rows = []
+    for config in configs:
+        walls = []
+        for _ in range(repeats):
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                start = time.perf_counter()
+                result = run_pagerank_filter(label="weighted_benchmark", plots=False, neighbor_map=neighbor_map,
+                                             cell_phases=cell_phases, save=False, **config)
+                walls.append(time.perf_counter() - start)
+        retained = result.loc[result["Iteration"] == result["Iteration"].max(), "Cell"]
+        rows.append(dict(config, wall_s=min(walls), iterations=int(result["Iteration"].max()), retained_cells=len(retained),
+                         phase_purity=phase_purity(result), retained_knn_purity=knn_phase_purity(neighbor_map, retained, cell_phases)))
+
+    base = rows[0]
+    for row in rows:
+        row["speedup"] = base["wall_s"] / row["wall_s"]
+        print(f"k={row['k']} weighted={row['weighted']!s:<5} norm={row['weight_norm']!s:<8} {row['wall_s']:6.2f} s x{row['speedup']:4.2f}  "
+              f"{row['iterations']:3d} iterations, {row['retained_cells']:4d} retained, phase purity {row['phase_purity']:.3f}, "
+              f"retained kNN purity {row['retained_knn_purity']:.3f}")
+
+    results = {"input_dir": input_dir, "environment": environment_info(), "runs": rows}
+    with open(resFn, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Weighted PageRank comparison saved to {resFn}")
+    return results
+
+
+if __name__ == "__main__":
+    run_benchmark(cellCounts=[50, 100, 200, 400])
@@ -0,0 +1,371 @@
+import pickle
+import numpy as np
+
+from createPairwiseSimilarities import isEligibleClique
+
+
+BLOCK_BYTES = 64 * 1024 * 1024 # Upper bound for temporary arrays in blockwise intersection counts
+DENSE_FRACTION = 1 / 32 # Rows with more set bits than this fraction of their width are stored as bitsets, see RowBitmaps
+
+if hasattr(np, "bitwise_count"): # numpy >= 2.0
+    def popcount(words):
+        # Number of set bits along the last axis
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+else:
+    _BYTE_BITS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def popcount(words):
+        # Number of set bits along the last axis
+        words = np.ascontiguousarray(words)
+        return _BYTE_BITS[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def _pack(rows, cols, nRows, nCols):
+    # Packed bitsets (nRows, ceil(nCols/64)) of uint64 with bit `col` set in row `row` for every (row, col) pair
+    words = np.zeros((nRows, max((nCols + 63) // 64, 1)), dtype=np.uint64)
+    np.bitwise_or.at(words, (rows, cols >> 6), np.left_shift(np.uint64(1), (cols & 63).astype(np.uint64)))
+    return words
+
+def _unpack(words, n):
+    # Positions of set bits of one packed row, in increasing order
+    bits = np.unpackbits(words.view(np.uint8), bitorder="little")[:n]
+    return np.flatnonzero(bits)
+
+def _ranges(starts, lengths):
+    # Concatenation of arange(start, start + length) for all starts and lengths
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(len(offsets))
+
+def _bitset_pairwise_counts(A, B):
+    # |A_i & B_j| for all rows of two packed bitset arrays, computed in blocks to bound memory
+    counts = np.empty((len(A), len(B)), dtype=np.int64)
+    if len(A) == 0 or len(B) == 0:
+        return counts
+    block = max(1, BLOCK_BYTES // max(1, B.shape[0] * B.shape[1] * 8))
+    for start in range(0, len(A), block):
+        counts[start:start+block] = popcount(A[start:start+block, None, :] & B[None, :, :])
+    return counts
+
+
+class RowBitmaps:
+    """
+    Rows of a 0/1 matrix with `width` columns, stored like the containers of a roaring bitmap: rows with more
+    than width*DENSE_FRACTION set bits as packed uint64 bitsets, sparser rows as sorted uint32 column ids.
+    A sparse row costs 4 bytes per set bit instead of width/8 bytes.
+
+    Attributes:
+    -----------
+    width : int
+        Number of columns.
+    indptr : numpy.ndarray
+        Offsets of each row's column ids in indices; dense rows have empty ranges.
+    indices : numpy.ndarray
+        Sorted uint32 column ids of the sparse rows.
+    dense_slot : numpy.ndarray
+        Row of bits holding each dense row, -1 for sparse rows. Dense rows keep their order in bits.
+    bits : numpy.ndarray
+        Packed bitsets (dense rows, ceil(width/64)) of uint64.
+    """
+
+    ARRAYS = ["indptr", "indices", "dense_slot", "bits"]
+
+    def __init__(self, width, indptr, indices, dense_slot, bits):
+        self.width = int(width)
+        self.indptr = indptr
+        self.indices = indices
+        self.dense_slot = dense_slot
+        self.bits = bits
+        self._counts = None
+
+    @classmethod
+    def from_pairs(cls, rows, cols, nRows, width):
+        # Rows with bit `col` set in row `row` for every distinct (row, col) pair
+        counts = np.bincount(rows, minlength=nRows)
+        dense = counts > width * DENSE_FRACTION
+        dense_slot = np.full(nRows, -1, dtype=np.int64)
+        dense_slot[dense] = np.arange(np.count_nonzero(dense))
+        inDense = dense[rows]
+        bits = _pack(dense_slot[rows[inDense]], cols[inDense], np.count_nonzero(dense), width)
+        sparseRows, sparseCols = rows[~inDense], cols[~inDense]
+        indices = sparseCols[np.lexsort((sparseCols, sparseRows))].astype(np.uint32)
+        indptr = np.r_[0, np.cumsum(np.where(dense, 0, counts))].astype(np.int64)
+        return cls(width, indptr, indices, dense_slot, bits)
+
+    def __len__(self):
+        return len(self.dense_slot)
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    def counts(self):
+        # Number of set bits of each row
+        if self._counts is None:
+            counts = np.diff(self.indptr)
+            dense = self.dense_slot >= 0
+            counts[dense] = popcount(self.bits[self.dense_slot[dense]])
+            self._counts = counts
+        return self._counts
+
+    def row(self, i):
+        # Sorted column ids of row i
+        if self.dense_slot[i] >= 0:
+            return _unpack(self.bits[self.dense_slot[i]], self.width)
+        return self.indices[self.indptr[i]:self.indptr[i+1]].astype(np.int64)
+
+    def expand(self, rows):
+        """
+        Set bits of the given rows as (owner, column) arrays, where owner is the position of the row in rows.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        owner = np.repeat(np.arange(len(rows)), lengths)
+        columns = self.indices[_ranges(starts, lengths)].astype(np.int64)
+        dense = np.flatnonzero(self.dense_slot[rows] >= 0)
+        if len(dense):
+            bits = np.unpackbits(self.bits[self.dense_slot[rows[dense]]].view(np.uint8), axis=1, bitorder="little")[:, :self.width]
+            denseOwner, denseColumns = np.nonzero(bits)
+            owner = np.r_[owner, dense[denseOwner]]
+            columns = np.r_[columns, denseColumns]
+        return owner, columns
+
+    def dense_rows_transposed(self):
+        # Packed bitsets (width, ceil(dense rows/64)): for every column, the dense rows with that column set
+        bits = np.unpackbits(self.bits.view(np.uint8), axis=1, bitorder="little")[:, :self.width]
+        packed = np.zeros((self.width, max((len(self.bits) + 63) // 64, 1) * 8), dtype=np.uint8)
+        packed[:, :(len(self.bits) + 7) // 8] = np.packbits(bits.T, axis=1, bitorder="little")
+        return packed.view(np.uint64)
+
+    def arrays(self, prefix):
+        # Arrays for np.savez, see from_arrays
+        return dict({f"{prefix}{name}": getattr(self, name) for name in self.ARRAYS}, **{f"{prefix}width": np.array(self.width)})
+
+    @classmethod
+    def from_arrays(cls, f, prefix):
+        return cls(int(f[f"{prefix}width"]), *(f[f"{prefix}{name}"] for name in cls.ARRAYS))
+
+
+def _block_rows(nB):
+    # Rows per block of a (rows, nB) int64 count matrix of at most BLOCK_BYTES
+    return max(1, BLOCK_BYTES // (8 * max(nB, 1)))
+
+def _intersection_counts(X, T, rowsA, rowsB, heavyBits):
+    """
+    Dense (len(rowsA), len(rowsB)) matrix of |X_a & X_b|, where T is the transposed orientation of X
+    (row k of T holds the rows of X with column k set). Columns stored sparsely in T are counted by expanding
+    them into the rows of X that contain them; the few dense columns with a popcount of heavyBits
+    (rows of X over the dense columns of T, see RowBitmaps.dense_rows_transposed).
+    """
+    nB = len(rowsB)
+    positionB = np.full(len(X), -1, dtype=np.int64)
+    positionB[rowsB] = np.arange(nB)
+    counts = np.zeros(len(rowsA) * nB, dtype=np.int64)
+    owner, columns = X.expand(rowsA)
+    light = T.dense_slot[columns] < 0
+    owner, columns = owner[light], columns[light]
+    # Expand the columns in chunks of about BLOCK_BYTES/16 (row, row) entries
+    cost = np.r_[0, np.cumsum(T.counts()[columns])]
+    start = 0
+    while start < len(columns):
+        stop = max(start + 1, int(np.searchsorted(cost, cost[start] + BLOCK_BYTES // 16, side="right")) - 1)
+        entry, other = T.expand(columns[start:stop])
+        position = positionB[other]
+        inB = position >= 0
+        counts += np.bincount(owner[start:stop][entry[inB]] * nB + position[inB], minlength=len(counts))
+        start = stop
+    counts = counts.reshape(len(rowsA), nB)
+    if heavyBits is not None:
+        counts += _bitset_pairwise_counts(heavyBits[rowsA], heavyBits[rowsB])
+    return counts
+
+def _heavy_bits(T):
+    # Rows of X over the dense rows of T, None if T has no dense rows
+    return T.dense_rows_transposed() if len(T.bits) else None
+
+def _pairwise_counts(X, T, rowsA, rowsB):
+    # |X_a & X_b| for all rows a of rowsA and b of rowsB, in blocks of rowsA
+    heavyBits = _heavy_bits(T)
+    counts = np.empty((len(rowsA), len(rowsB)), dtype=np.int64)
+    block = _block_rows(len(rowsB))
+    for start in range(0, len(rowsA), block):
+        counts[start:start+block] = _intersection_counts(X, T, rowsA[start:start+block], rowsB, heavyBits)
+    return counts
+
+
+class CellBitsetIndex:
+    """
+    Bitmap index of cell membership for links or cliques, as an alternative to the
+    `link_cells` / `clique_cells` dictionaries of sorted lists or sets of cell indices.
+
+    Memberships are stored in both orientations as RowBitmaps (sparse rows as sorted uint32 ids,
+    dense rows as packed uint64 bitsets):
+        key_rows[k]  - cells containing key k (link or clique),
+        cell_rows[c] - keys found in cell c,
+    so that intersection counts are vectorized expansions over sparse rows and AND/popcount over dense rows.
+
+    Attributes:
+    -----------
+    keys : list
+        Links (A, B) or cliques (sorted tuples of loci), in the order of key_rows.
+    cellIDs : numpy.ndarray
+        Sorted cell indices, in the order of cell_rows and of the columns of key_rows.
+    """
+
+    def __init__(self, keys, cellIDs, key_rows, cell_rows):
+        self.keys = keys
+        self.cellIDs = np.asarray(cellIDs)
+        self.key_rows = key_rows
+        self.cell_rows = cell_rows
+        self.key_position = {key: i for i, key in enumerate(keys)}
+        self.cell_position = {int(cell): i for i, cell in enumerate(self.cellIDs)}
+
+    @classmethod
+    def from_membership(cls, membership, cellIDs, minCells=1):
+        """
+        Builds the index from {key: iterable of cell indices}, e.g. data["link_cells"] or data["clique_cells"]["K4"].
+        Keys found in fewer than minCells cells are left out (minCells=2 keeps only keys that can be shared).
+        """
+        cellIDs = np.array(sorted(cellIDs))
+        position = {int(cell): i for i, cell in enumerate(cellIDs)}
+        keys, rows, cols = [], [], []
+        for key, cells in membership.items():
+            if len(cells) < minCells:
+                continue
+            row = len(keys)
+            keys.append(key)
+            rows.extend([row] * len(cells))
+            cols.extend(position[cell] for cell in cells)
+        rows = np.array(rows, dtype=np.int64)
+        cols = np.array(cols, dtype=np.int64)
+        key_rows = RowBitmaps.from_pairs(rows, cols, len(keys), len(cellIDs))
+        cell_rows = RowBitmaps.from_pairs(cols, rows, len(cellIDs), len(keys))
+        return cls(keys, cellIDs, key_rows, cell_rows)
+
+    # Single key / cell queries
+    def cells_of(self, key):
+        return self.cellIDs[self.key_rows.row(self.key_position[key])]
+
+    def keys_of(self, cell):
+        return [self.keys[i] for i in self.cell_rows.row(self.cell_position[cell])]
+
+    def key_counts(self):
+        # Number of cells containing each key, in the order of self.keys
+        return self.key_rows.counts()
+
+    def cell_counts(self):
+        # Number of keys found in each cell, in the order of self.cellIDs
+        return self.cell_rows.counts()
+
+    def _key_ids(self, keys):
+        return np.arange(len(self.keys)) if keys is None else np.array([self.key_position[key] for key in keys], dtype=np.int64)
+
+    def _cell_ids(self, cells):
+        return np.arange(len(self.cellIDs)) if cells is None else np.array([self.cell_position[cell] for cell in cells], dtype=np.int64)
+
+    # Set operations over keys
+    def cells_with_all(self, keys):
+        # Cells containing every key (intersection of the keys' cell sets)
+        rows = self._key_ids(keys)
+        _, columns = self.key_rows.expand(rows)
+        return self.cellIDs[np.flatnonzero(np.bincount(columns, minlength=len(self.cellIDs)) == len(rows))]
+
+    def cells_with_any(self, keys):
+        # Cells containing at least one key (union of the keys' cell sets)
+        _, columns = self.key_rows.expand(self._key_ids(keys))
+        return self.cellIDs[np.unique(columns)]
+
+    # Vectorized intersection counts
+    def key_intersection_counts(self, keysA=None, keysB=None):
+        """
+        Matrix of the number of cells shared by each pair of keys (all keys if keysA / keysB is None).
+        """
+        return _pairwise_counts(self.key_rows, self.cell_rows, self._key_ids(keysA), self._key_ids(keysB))
+
+    def cell_intersection_counts(self, cellsA=None, cellsB=None):
+        """
+        Matrix of the number of keys shared by each pair of cells (all cells if cellsA / cellsB is None).
+        For a clique index this is the pairwise similarity of callPairwiseSimilarites. The matrix is dense;
+        for all pairs of many cells use cell_pair_counts.
+        """
+        return _pairwise_counts(self.cell_rows, self.key_rows, self._cell_ids(cellsA), self._cell_ids(cellsB))
+
+    def cell_pair_counts(self):
+        """
+        (cell1, cell2, count) arrays of all pairs cell1 < cell2 sharing at least one key. Counted in blocks of cells
+        against the cells after them, keeping only nonzero counts, so the cells x cells matrix is never built.
+        """
+        n = len(self.cellIDs)
+        heavyBits = _heavy_bits(self.key_rows)
+        cell1, cell2, frequency = [], [], []
+        start = 0
+        while start < n:
+            stop = min(n, start + _block_rows(n - start))
+            counts = _intersection_counts(self.cell_rows, self.key_rows, np.arange(start, stop), np.arange(start, n), heavyBits)
+            a, b = np.nonzero(counts)
+            upper = b > a
+            a, b = a[upper], b[upper]
+            cell1.append(self.cellIDs[start + a])
+            cell2.append(self.cellIDs[start + b])
+            frequency.append(counts[a, b])
+            start = stop
+        if not cell1:
+            return self.cellIDs[:0], self.cellIDs[:0], np.empty(0, dtype=np.int64)
+        return np.concatenate(cell1), np.concatenate(cell2), np.concatenate(frequency)
+
+    def cell_pair_frequencies(self):
+        """
+        {(cell1, cell2): number of shared keys} for cell1 < cell2 sharing at least one key,
+        in the format of createPairwiseSimilarities.countCliquePairs.
+        """
+        cell1, cell2, frequency = self.cell_pair_counts()
+        return dict(zip(zip(cell1.tolist(), cell2.tolist()), frequency.tolist()))
+
+    def nbytes(self):
+        # Memory of both orientations
+        return self.key_rows.nbytes() + self.cell_rows.nbytes()
+
+    # Persistence next to the pickles
+    def save(self, fn):
+        # Keys as a (keys, key length) array; an index without keys (e.g. minCells > 1 on long cliques) has shape (0, 0)
+        keys = np.array(self.keys, dtype=np.int64).reshape(len(self.keys), -1) if self.keys else np.empty((0, 0), dtype=np.int64)
+        np.savez_compressed(fn, keys=keys, cellIDs=self.cellIDs, **self.key_rows.arrays("key_"), **self.cell_rows.arrays("cell_"))
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as f:
+            keys = [tuple(int(x) for x in row) for row in f["keys"]]
+            return cls(keys, f["cellIDs"], RowBitmaps.from_arrays(f, "key_"), RowBitmaps.from_arrays(f, "cell_"))
+
+
+def bitset_index_fn(pickleFn, name):
+    # e.g. base100k-chr18-100000-cliques.pkl, "K4-alllengths" -> base100k-chr18-100000-cliques-K4-alllengths-bitsets.npz
+    return f"{pickleFn[:-len('.pkl')] if pickleFn.endswith('.pkl') else pickleFn}-{name}-bitsets.npz"
+
+def build_link_index(baseFn, minCells=1, save=True):
+    """
+    Bitset index of data["link_cells"] from a pickle created by process_cells, saved next to it.
+    """
+    with open(baseFn, "rb") as f:
+        data = pickle.load(f)
+    index = CellBitsetIndex.from_membership(data["link_cells"], data["cell_IDs"], minCells=minCells)
+    if save:
+        index.save(bitset_index_fn(baseFn, "links"))
+    return index
+
+def build_clique_index(cliquesFn, motifName="K4", motifLength="alllengths", minCells=1, save=True):
+    """
+    Bitset index of data["clique_cells"][motifName] from a pickle created by createCliquePickles, saved next to it.
+    With motifLength="long" only cliques considered long by callPairwiseSimilarites are indexed.
+    """
+    with open(cliquesFn, "rb") as f:
+        data = pickle.load(f)
+    membership = {clique: cells for clique, cells in data["clique_cells"][motifName].items() if isEligibleClique(clique, motifLength)}
+    index = CellBitsetIndex.from_membership(membership, data["cell_IDs"], minCells=minCells)
+    if save:
+        index.save(bitset_index_fn(cliquesFn, f"{motifName}-{motifLength}"))
+    return index
+
+
+if __name__ == "__main__":
+    index = build_clique_index("base100k-chr18-100000-cliques.pkl", motifName="K4", motifLength="long")
+    print(f"{len(index.keys)} cliques, {len(index.cellIDs)} cells indexed")
@@ -0,0 +1,298 @@
+import io
+import os
+import contextlib
+from collections import defaultdict
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import networkx as nx
+
+import instrumentation
+from runSCHiCRank import K, build_full_neighbor_map, load_cell_phases, normalize_neighbor_weights, run_pagerank_filter
+
+
+class SharedNeighborMap:
+    """
+    Neighbor map packed into one shared memory block, so worker processes can attach to it without copying.
+    Per chromosome (in key order) the cells with neighbors are stored in CSR form:
+        cells[cell_ptr[c]:cell_ptr[c+1]]          - cells of chromosome c
+        neighbors[entry_ptr[i]:entry_ptr[i+1]]    - neighbors of cells[i], by descending frequency
+        frequencies[entry_ptr[i]:entry_ptr[i+1]]  - their frequencies (or weights)
+        entry_rows[entry_ptr[i]:entry_ptr[i+1]]   - i, relative to the first cell of the chromosome
+    `spec` is a small picklable description used by `attach` in other processes.
+    """
+
+    def __init__(self, shm, spec):
+        self.shm = shm
+        self.spec = spec
+        self.keys = spec["keys"]
+        self.arrays = {name: np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+                       for name, (offset, dtype, shape) in spec["arrays"].items()}
+
+    @classmethod
+    def create(cls, neighbor_map):
+        keys = list(neighbor_map.keys())
+        cells, counts, entry_rows, neighbors, frequencies, cell_ptr = [], [], [], [], [], [0]
+        for key in keys:
+            neighbor_dict = neighbor_map[key]
+            for row, cell in enumerate(sorted(neighbor_dict)):
+                entries = neighbor_dict[cell]
+                cells.append(cell)
+                counts.append(len(entries))
+                entry_rows.extend([row] * len(entries))
+                neighbors.extend(n for n, _ in entries)
+                frequencies.extend(f for _, f in entries)
+            cell_ptr.append(len(cells))
+        frequencies = np.array(frequencies)
+        arrays = {
+            "cell_ptr": np.array(cell_ptr, dtype=np.int64),
+            "cells": np.array(cells, dtype=np.int64),
+            "entry_ptr": np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]),
+            "entry_rows": np.array(entry_rows, dtype=np.int64),
+            "neighbors": np.array(neighbors, dtype=np.int64),
+            "frequencies": frequencies if frequencies.dtype.kind == "f" else frequencies.astype(np.int64),
+        }
+
+        spec = {"keys": keys, "arrays": {}}
+        offset = 0
+        for name, array in arrays.items():
+            spec["arrays"][name] = (offset, array.dtype.str, array.shape)
+            offset += -(-array.nbytes // 8) * 8 # 8 byte aligned
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        spec["name"] = shm.name
+        shared = cls(shm, spec)
+        for name, array in arrays.items():
+            shared.arrays[name][...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, spec):
+        try:
+            shm = shared_memory.SharedMemory(name=spec["name"], track=False) # Python >= 3.13
+        except TypeError:
+            # Pool workers share the creating process' resource tracker, which unlinks the block only if it leaks
+            shm = shared_memory.SharedMemory(name=spec["name"])
+        return cls(shm, spec)
+
+    def chromosomes(self):
+        # {key: CSRNeighborDict} views of the shared arrays, valid while the block is open
+        a = self.arrays
+        views = {}
+        for c, key in enumerate(self.keys):
+            first, last = int(a["cell_ptr"][c]), int(a["cell_ptr"][c+1])
+            start, end = int(a["entry_ptr"][first]), int(a["entry_ptr"][last])
+            views[key] = CSRNeighborDict(a["cells"][first:last], a["entry_ptr"][first:last+1] - start,
+                                         a["entry_rows"][start:end], a["neighbors"][start:end], a["frequencies"][start:end])
+        return views
+
+    def to_neighbor_map(self):
+        # Rebuilds {key: defaultdict(list) cell -> [(neighbor, frequency), ...]} as used by run_pagerank_filter
+        a = self.arrays
+        cells, entry_ptr = a["cells"].tolist(), a["entry_ptr"].tolist()
+        neighbors, frequencies = a["neighbors"].tolist(), a["frequencies"].tolist()
+        neighbor_map = {}
+        for c, key in enumerate(self.keys):
+            neighbor_dict = defaultdict(list)
+            for i in range(a["cell_ptr"][c], a["cell_ptr"][c+1]):
+                start, end = entry_ptr[i], entry_ptr[i+1]
+                neighbor_dict[cells[i]] = list(zip(neighbors[start:end], frequencies[start:end]))
+            neighbor_map[key] = neighbor_dict
+        return neighbor_map
+
+    def close(self):
+        self.arrays = {}
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+
+class CSRNeighborDict:
+    """
+    One chromosome of a SharedNeighborMap, read in place from the shared arrays (all relative to the chromosome):
+    the neighbors of cells[i] are neighbors[entry_ptr[i]:entry_ptr[i+1]] with weights[entry_ptr[i]:entry_ptr[i+1]].
+    run_pagerank_filter uses its knn_graph method (see runSCHiCRank.build_knn_graph), so workers do not need
+    a copy of the neighbor lists as Python objects.
+    """
+
+    def __init__(self, cells, entry_ptr, entry_rows, neighbors, weights):
+        self.cells = cells
+        self.entry_ptr = entry_ptr
+        self.entry_rows = entry_rows
+        self.neighbors = neighbors
+        self.weights = weights
+        self.row_of = {cell: row for row, cell in enumerate(cells.tolist())}
+        self.size = int(max(cells.max(initial=-1), neighbors.max(initial=-1))) + 1
+
+    def get(self, cell, default=None):
+        # Neighbor list [(neighbor, weight), ...] of cell, as in a neighbor dict
+        row = self.row_of.get(cell)
+        if row is None:
+            return default
+        start, end = self.entry_ptr[row], self.entry_ptr[row+1]
+        return list(zip(self.neighbors[start:end].tolist(), self.weights[start:end].tolist()))
+
+    def knn_graph(self, active_cells, k, weighted=False):
+        # Same graph as runSCHiCRank.build_knn_graph on the neighbor dict: the top k active neighbors of every active cell
+        active = np.zeros(max(self.size, max(active_cells, default=-1) + 1), dtype=bool)
+        active[np.fromiter(active_cells, dtype=np.int64, count=len(active_cells))] = True
+        keep = active[self.neighbors] & active[self.cells][self.entry_rows]
+        kept = np.concatenate([[0], np.cumsum(keep)])
+        rank = kept[:-1] - kept[self.entry_ptr[:-1]][self.entry_rows] # Active neighbors before the entry in its row
+        selected = np.flatnonzero(keep & (rank < k))
+        bounds = np.searchsorted(self.entry_rows[selected], np.arange(len(self.cells) + 1)).tolist()
+        neighbors = self.neighbors[selected].tolist()
+        weights = self.weights[selected].tolist()
+
+        # Edges are added in the order of active_cells, like build_knn_graph, so PageRank sums up identically
+        G = nx.DiGraph()
+        for cell in active_cells:
+            row = self.row_of.get(cell)
+            if row is None:
+                continue
+            start, end = bounds[row], bounds[row+1]
+            if weighted:
+                G.add_weighted_edges_from((cell, n, w) for n, w in zip(neighbors[start:end], weights[start:end]))
+            else:
+                G.add_edges_from((cell, n) for n in neighbors[start:end])
+        return G
+
+
+# Worker state, set up once per process by _init_worker
+_worker = {}
+
+def _init_worker(spec, cell_phases):
+    # The block stays attached for the life of the worker, the chromosome views read from it
+    shared = SharedNeighborMap.attach(spec)
+    _worker["shared"] = shared
+    _worker["neighbor_map"] = shared.chromosomes()
+    _worker["cell_phases"] = cell_phases
+
+def resample(neighbor_map, cell_count, rng, mode="chromosomes", cellFraction=0.8):
+    """
+    Draws one replicate:
+        mode="chromosomes" - bootstrap of the chromosomes (drawn with replacement, all cells),
+        mode="cells"       - all chromosomes, a random cellFraction of the cells (without replacement).
+    Returns (neighbor_map, cells, multiplicities) to be passed to run_pagerank_filter: cells is None for all cells,
+    multiplicities counts how often each distinct drawn chromosome was drawn (None if every chromosome counts once).
+    """
+    keys = list(neighbor_map.keys())
+    if mode == "chromosomes":
+        drawn, multiplicities = np.unique(rng.choice(len(keys), size=len(keys), replace=True), return_counts=True)
+        return {keys[i]: neighbor_map[keys[i]] for i in drawn}, None, multiplicities.tolist()
+    if mode == "cells":
+        cells = np.sort(rng.choice(cell_count, size=max(1, int(round(cellFraction * cell_count))), replace=False))
+        return neighbor_map, cells, None
+    raise ValueError(f"Unknown resampling mode {mode}")
+
+def _run_replicate(replicate, seed, mode, cellFraction, filterArgs):
+    neighbor_map, cell_phases = _worker["neighbor_map"], _worker["cell_phases"]
+    rng = np.random.default_rng([seed, replicate])
+    sample, cells, multiplicities = resample(neighbor_map, len(cell_phases), rng, mode=mode, cellFraction=cellFraction)
+    with contextlib.redirect_stdout(io.StringIO()): # Per iteration output of run_pagerank_filter
+        result = run_pagerank_filter(label=f"replicate{replicate}", plots=False, neighbor_map=sample, cells=cells,
+                                     cell_phases=cell_phases, save=False, multiplicities=multiplicities, **filterArgs)
+    return replicate, result["Cell"].to_numpy(), result["Iteration"].to_numpy(), result["Score"].to_numpy()
+
+
+def aggregate_replicates(replicates, cell_phases):
+    """
+    Aggregates per replicate results (columns Replicate, Cell, Iteration, Score as from run_pagerank_filter) per cell:
+    number of replicates containing the cell, distribution of its removal iteration (absolute and relative to the
+    replicate's last iteration), the fraction of replicates in which it was retained until the end, and the
+    distribution of its score when removed.
+    """
+    replicates = replicates.copy()
+    lastIteration = replicates.groupby("Replicate")["Iteration"].transform("max")
+    replicates["RelativeIteration"] = replicates["Iteration"] / lastIteration
+    replicates["Retained"] = replicates["Iteration"] == lastIteration
+    replicates["RemovalScore"] = replicates["Score"].where(~replicates["Retained"])
+
+    grouped = replicates.groupby("Cell")
+    table = pd.DataFrame({
+        "Replicates": grouped.size(),
+        "Iteration_mean": grouped["Iteration"].mean(),
+        "Iteration_std": grouped["Iteration"].std(),
+        "Iteration_min": grouped["Iteration"].min(),
+        "Iteration_median": grouped["Iteration"].median(),
+        "Iteration_max": grouped["Iteration"].max(),
+        "RelativeIteration_mean": grouped["RelativeIteration"].mean(),
+        "RelativeIteration_std": grouped["RelativeIteration"].std(),
+        "Retained_fraction": grouped["Retained"].mean(),
+        "Score_mean": grouped["RemovalScore"].mean(),
+        "Score_std": grouped["RemovalScore"].std(),
+        "Score_median": grouped["RemovalScore"].median(),
+    })
+    table.index.name = "Cell"
+    table.insert(0, "Phase", [cell_phases[cell] if cell < len(cell_phases) else "Unknown" for cell in table.index])
+    return table.reset_index()
+
+
+@instrumentation.timed("run_consensus_filter")
+def run_consensus_filter(INPUT_DIR=None,
+                         label="consensus",
+                         replicates=100,
+                         mode="chromosomes",
+                         cellFraction=0.8,
+                         seed=0,
+                         workers=None,
+                         neighbor_map=None,
+                         save=True,
+                         saveReplicates=False,
+                         **filterArgs):
+    """
+    Runs `replicates` resampled trajectories of run_pagerank_filter in a process pool and aggregates them per cell.
+    The neighbor map is loaded once and placed in shared memory; every worker attaches to it once and builds
+    its kNN graphs from the shared arrays. A chromosome drawn several times in a bootstrap sample is ranked once.
+
+    Parameters:
+        INPUT_DIR (str): Directory with pairwise similarity CSV files, as for run_pagerank_filter.
+        label (str): Output files are consensus_{label}.csv (and replicates_{label}.csv).
+        replicates (int): Number of resampled trajectories.
+        mode (str): "chromosomes" (bootstrap of chromosomes) or "cells" (subsample of cellFraction of the cells).
+        seed (int): Replicate r uses the random generator seeded with (seed, r), so results do not depend on workers.
+        workers (int): Number of worker processes, default the number of CPUs.
+        neighbor_map (dict): Neighbor map already in memory; if given, INPUT_DIR is not read.
+        saveReplicates (bool): Also save the per replicate results as replicates_{label}.csv.
+        filterArgs: Passed to run_pagerank_filter, e.g. k, weighted, weight_norm.
+    Returns:
+        pandas.DataFrame with one row per cell, see aggregate_replicates.
+    """
+    if neighbor_map is None:
+        neighbor_map = build_full_neighbor_map(INPUT_DIR)
+    weight_norm = filterArgs.pop("weight_norm", None)
+    if weight_norm is not None:
+        # Normalized weights do not depend on the replicate, so they are computed once and shared
+        neighbor_map = {key: normalize_neighbor_weights(neighbor_dict, weight_norm) for key, neighbor_dict in neighbor_map.items()}
+        filterArgs["weighted"] = True
+    cell_phases = list(load_cell_phases())
+    filterArgs.setdefault("k", K)
+    workers = workers or os.cpu_count() or 1
+
+    shared = SharedNeighborMap.create(neighbor_map)
+    results = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(shared.spec, cell_phases)) as pool:
+            futures = [pool.submit(_run_replicate, r, seed, mode, cellFraction, filterArgs) for r in range(replicates)]
+            for future in futures:
+                replicate, cells, iterations, scores = future.result()
+                results.append(pd.DataFrame({"Replicate": replicate, "Cell": cells, "Iteration": iterations, "Score": scores}))
+                instrumentation.count("run_consensus_filter.replicates")
+    finally:
+        shared.unlink()
+
+    replicateTable = pd.concat(results, ignore_index=True)
+    table = aggregate_replicates(replicateTable, cell_phases)
+    if save:
+        table.to_csv(f"consensus_{label}.csv", index=False)
+        print(f"Consensus of {replicates} replicates saved to consensus_{label}.csv")
+    if saveReplicates:
+        replicateTable.to_csv(f"replicates_{label}.csv", index=False)
+    return table
+
+
+if __name__ == "__main__":
+    run_consensus_filter("K4_imputed_long_3.0", label="K4_imputed_long_3.0", replicates=100, mode="chromosomes")
@@ -1,8 +1,10 @@
 import pickle
 import os
+import instrumentation
 
 
 # Helper function to process cliques
+@instrumentation.timed("process_cliques")
 def process_cliques(fn, resFN):
 
     counts = {}
@@ -1,8 +1,34 @@
 import pickle
 import networkx as nx
 import os
+import instrumentation
 
 
+def findCellCliques(links, ch=None, cellID=None):
+    # Maximal cliques with at most 8 nodes in the graph of one cell's links
+    with instrumentation.span("createCliquePickles.enumerate", chr=ch, cell=cellID) as s:
+        G = nx.Graph()
+        G.add_edges_from(links)
+
+        cliques_up_to_8 = [clique for clique in nx.find_cliques(G) if len(clique) <= 8]
+        s.set(links=G.number_of_edges(), cliques=len(cliques_up_to_8))
+    instrumentation.count("createCliquePickles.cliques", len(cliques_up_to_8))
+    return cliques_up_to_8
+
+
+def addCellCliquesToResult(resObj, cellID, cliques_up_to_8):
+    # Fills cell_cliques and clique_cells of resObj with the cliques of one cell
+    for cliqueSize in [3,4,5,6,7,8]:
+        KN = f"K{cliqueSize}"
+        cliques = [tuple(sorted(clique)) for clique in cliques_up_to_8 if len(clique) == cliqueSize]
+        resObj["cell_cliques"][KN][cellID] = set(cliques)
+        for clique in cliques:
+            if clique not in resObj["clique_cells"][KN]:
+                resObj["clique_cells"][KN][clique] = set()
+            resObj["clique_cells"][KN][clique].add(cellID)
+
+
+@instrumentation.timed("createCliquePickles")
 def createCliquePickles(
                         baseFn: str,
                         resFn: str,
@@ -25,18 +51,8 @@ def createCliquePickles(
 
     for cellID in data["cell_IDs"]:
         print(cellID)
-        G = nx.Graph()
-        G.add_edges_from(data["cell_links"][cellID])
-
-        cliques_up_to_8 = [clique for clique in nx.find_cliques(G) if len(clique) <= 8]
-        for cliqueSize in [3,4,5,6,7,8]:
-            KN = f"K{cliqueSize}"
-            cliques = [tuple(sorted(clique)) for clique in cliques_up_to_8 if len(clique) == cliqueSize]
-            resObj["cell_cliques"][KN][cellID] = set(cliques)
-            for clique in cliques:
-                if clique not in resObj["clique_cells"][KN]:
-                    resObj["clique_cells"][KN][clique] = set()
-                resObj["clique_cells"][KN][clique].add(cellID)
+        cliques_up_to_8 = findCellCliques(data["cell_links"][cellID], data["chr"], cellID)
+        addCellCliquesToResult(resObj, cellID, cliques_up_to_8)
         iii=0
     
 
@@ -47,6 +63,40 @@ def createCliquePickles(
     return resObj
 
 
+@instrumentation.timed("addCellCliques")
+def addCellCliques(baseFn: str,
+                   resFn: str,
+                   newCellIDs,
+                   ):
+    """
+    Incremental counterpart of createCliquePickles: enumerates cliques only for newCellIDs (already merged
+    into baseFn by processOriginalCoolDataset.add_cells) and adds them to the existing clique pickle resFn.
+    Falls back to createCliquePickles if resFn does not exist yet.
+    """
+    if not os.path.exists(resFn):
+        return createCliquePickles(baseFn, resFn)
+
+    with open(baseFn, 'rb') as f:
+        data = pickle.load(f)
+    with open(resFn, 'rb') as f:
+        resObj = pickle.load(f)
+
+    for key in ["index_to_name", "index_to_type", "cell_IDs"]:
+        resObj[key] = data[key]
+    for KN in resObj["cell_cliques"]:
+        for cellID in data["cell_IDs"]:
+            resObj["cell_cliques"][KN].setdefault(cellID, set())
+
+    for cellID in newCellIDs:
+        print(cellID)
+        cliques_up_to_8 = findCellCliques(data["cell_links"].get(cellID, []), data["chr"], cellID)
+        addCellCliquesToResult(resObj, cellID, cliques_up_to_8)
+
+    with open(resFn, 'wb') as f:
+        pickle.dump(resObj, f)
+    print("Saved cliques to", resFn)
+    return resObj
+
 
 if __name__ == "__main__":
     # Example usage
@@ -1,11 +1,145 @@
 import pickle
 import os
 from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import csv
+import gzip
+import heapq
+import zipfile
+import numpy as np
+import pandas as pd
+import instrumentation
 
 
+LONG_CLIQUE_MIN_SPAN = 2000000 #Cliques spanning at least this many bp are considered long
 
-def callPairwiseSimilarites(filename):
+
+def isEligibleClique(clique, motifLength):
+    #Cliques are sorted tuples of loci, so the span is last minus first
+    if motifLength == "long":
+        return clique[-1]-clique[0] >= LONG_CLIQUE_MIN_SPAN
+    return True
+
+
+def countCliquePairs(data, motifName, motifLength):
+    """
+    Counts for each pair of cells the number of cliques of type motifName (e.g. "K4") they share.
+    Returns dict {(cell1, cell2): frequency} with cell1 < cell2.
+    """
+    with instrumentation.span("countCliquePairs", chr=data["chr"], motif=f"{motifName}-{motifLength}") as s:
+        cellPairFrequencies = dict()
+        for clique, listOfCells in data["clique_cells"][motifName].items():
+            if len(listOfCells) <=1:
+                continue
+
+            #Check clique length
+            if not isEligibleClique(clique, motifLength):
+                continue #Do not process this clique because it is considered short
+            
+            for cell1, cell2 in combinations(listOfCells, 2):
+                if cell1 > cell2:
+                    cell1, cell2 = cell2, cell1
+                pair = (cell1, cell2)
+                if pair not in cellPairFrequencies:
+                    cellPairFrequencies[pair] = 0
+                cellPairFrequencies[pair] += 1
+        s.set(pairs=len(cellPairFrequencies))
+    instrumentation.count("countCliquePairs.pairs", len(cellPairFrequencies))
+    return cellPairFrequencies
+
+
+def countNewCellPairs(data, motifName, motifLength, newCellIDs):
+    """
+    Incremental counterpart of countCliquePairs: counts only pairs involving at least one of newCellIDs
+    (new x old and new x new), visiting only cliques of the new cells.
+    Returns dict {(cell1, cell2): frequency} with cell1 < cell2.
+    """
+    newCells = set(newCellIDs)
+    with instrumentation.span("countNewCellPairs", chr=data["chr"], motif=f"{motifName}-{motifLength}", cells=len(newCells)) as s:
+        cliques = set()
+        for cellID in newCells:
+            cliques.update(data["cell_cliques"][motifName].get(cellID, ()))
+
+        cellPairFrequencies = dict()
+        for clique in cliques:
+            listOfCells = data["clique_cells"][motifName][clique]
+            if len(listOfCells) <=1 or not isEligibleClique(clique, motifLength):
+                continue
+            newInClique = sorted(cell for cell in listOfCells if cell in newCells)
+            oldInClique = [cell for cell in listOfCells if cell not in newCells]
+            pairs = [(cell1, cell2) for cell1 in newInClique for cell2 in oldInClique] + list(combinations(newInClique, 2))
+            for cell1, cell2 in pairs:
+                pair = (cell1, cell2) if cell1 < cell2 else (cell2, cell1)
+                cellPairFrequencies[pair] = cellPairFrequencies.get(pair, 0) + 1
+        s.set(pairs=len(cellPairFrequencies))
+    return cellPairFrequencies
+
+
+PAIRWISE_FIELDNAMES = ["Item 1", "Item 2", "Frequency", "cell1_name", "cell2_name", "cell1_phase", "cell2_phase", "same?", "type"]
+
+def pairwiseRow(pair, frequency, data):
+    # One CSV row in the order of PAIRWISE_FIELDNAMES
+    return [
+        pair[0],
+        pair[1],
+        frequency,
+        data["index_to_name"][pair[0]],
+        data["index_to_name"][pair[1]],
+        data["index_to_type"][pair[0]],
+        data["index_to_type"][pair[1]],
+        data["index_to_type"][pair[0]] == data["index_to_type"][pair[1]],
+        f'{data["index_to_type"][pair[0]]}+{data["index_to_type"][pair[1]]}'
+    ]
+
+
+@instrumentation.timed("savePairwiseSimilarities")
+def savePairwiseSimilarities(resultFn, cellPairFrequencies, data):
+    # Sort the pairs by frequency in descending order
+    sorted_pairs = sorted(cellPairFrequencies.items(), key=lambda x: x[1], reverse=True)
+
+    # Save the pairwise frequencies as csv
+    with open(resultFn, "w", newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(PAIRWISE_FIELDNAMES)
+        for pair, frequency in sorted_pairs:
+            writer.writerow(pairwiseRow(pair, frequency, data))
+
+
+@instrumentation.timed("savePairArrays")
+def savePairArrays(resultFn, item1, item2, frequency, data):
+    # savePairwiseSimilarities for arrays from pairFrequenciesToArrays, whose rows are already in CSV order
+    with open(resultFn, "w", newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(PAIRWISE_FIELDNAMES)
+        for cell1, cell2, pairFrequency in zip(item1.tolist(), item2.tolist(), frequency.tolist()):
+            writer.writerow(pairwiseRow((cell1, cell2), pairFrequency, data))
+
+
+@instrumentation.timed("mergePairwiseSimilarities")
+def mergePairwiseSimilarities(resultFn, newPairFrequencies, data):
+    """
+    Adds rows for new pairs to an existing CSV written by savePairwiseSimilarities, keeping the rows sorted by
+    descending frequency. Existing rows are streamed, not parsed into a table, and come first among equal frequencies.
+    """
+    sorted_pairs = sorted(newPairFrequencies.items(), key=lambda x: x[1], reverse=True)
+    newRows = (pairwiseRow(pair, frequency, data) for pair, frequency in sorted_pairs)
+    tmpFn = f"{resultFn}.tmp"
+    with open(resultFn, newline='') as oldFile, open(tmpFn, "w", newline='') as csvfile:
+        reader = csv.reader(oldFile)
+        writer = csv.writer(csvfile)
+        writer.writerow(next(reader))
+        writer.writerows(heapq.merge(reader, newRows, key=lambda row: -int(row[2])))
+    os.replace(tmpFn, resultFn)
+
+
+@instrumentation.timed("callPairwiseSimilarites")
+def callPairwiseSimilarites(filename, compact=False, fmt="npz"):
+    """
+    Writes the pairwise similarities of every motif and length of a clique pickle. With compact=True only the
+    integer columns are written, as .npz or .csv.gz (fmt), with one cell metadata file per type, see writeCompactPairs.
+    Full CSV files go to pairwiseSimilarities/, compact files to pairwiseSimilarities_compact/ (see pairwiseResultFn).
+    """
     with open(filename, "rb") as f:
         data = pickle.load(f) #Read clique data
     iii=0
@@ -14,59 +148,223 @@ def callPairwiseSimilarites(filename):
     motifNames = data["clique_cells"].keys()
     motifLengths = ["alllengths", "long"]
     cellIDs = data["cell_IDs"]
+    if compact:
+        saveCellMetadata(cellMetadataFn(typ), data)
 
     for motifName in motifNames:
         for motifLength in motifLengths:
-            
-            resultDir = f"pairwiseSimilarities/{motifName}-{motifLength}/"
-            os.makedirs(resultDir, exist_ok=True)
-            resultFn = f'{resultDir}pairwiseSimilarities-{typ}-{data["chr"]}-{data["resolution"]}-{motifName}-{motifLength}.csv'
+            resultFn = pairwiseResultFn(data, motifName, motifLength, compact=compact, fmt=fmt)
             print(f"Processing {resultFn}")
-            cellPairFrequencies = dict()
-            for clique, listOfCells in data["clique_cells"][motifName].items():
-                if len(listOfCells) <=1:
-                    continue
-
-                #Check clique length
-                if motifLength == "long":
-                    if clique[-1]-clique[0]<2000000:
-                        continue #Do not process this clique because it is considered short
-                
-                for cell1, cell2 in combinations(listOfCells, 2):
-                    if cell1 > cell2:
-                        cell1, cell2 = cell2, cell1
-                    pair = (cell1, cell2)
-                    if pair not in cellPairFrequencies:
-                        cellPairFrequencies[pair] = 0
-                    cellPairFrequencies[pair] += 1
-                
-            # Sort the pairs by frequency in descending order
-            sorted_pairs = sorted(cellPairFrequencies.items(), key=lambda x: x[1], reverse=True)
-
-            # Save the pairwise frequencies as csv
-            with open(resultFn, "w", newline='') as csvfile:
-                fieldnames = ["Item 1", "Item 2", "Frequency", "cell1_name", "cell2_name", "cell1_phase", "cell2_phase", "same?", "type"]
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                for pair, frequency in sorted_pairs:
-                    writer.writerow({
-                        "Item 1": pair[0],
-                        "Item 2": pair[1],
-                        "Frequency": frequency,
-                        "cell1_name": data["index_to_name"][pair[0]],
-                        "cell2_name": data["index_to_name"][pair[1]],
-                        "cell1_phase": data["index_to_type"][pair[0]],
-                        "cell2_phase": data["index_to_type"][pair[1]],
-                        "same?": data["index_to_type"][pair[0]] == data["index_to_type"][pair[1]],
-                        "type": f'{data["index_to_type"][pair[0]]}+{data["index_to_type"][pair[1]]}'
-                    })
-
-                
+            cellPairFrequencies = countCliquePairs(data, motifName, motifLength)
+            if compact:
+                writeCompactPairs(resultFn, *pairFrequenciesToArrays(cellPairFrequencies))
+            else:
+                savePairwiseSimilarities(resultFn, cellPairFrequencies, data)
+
+
+@instrumentation.timed("addPairwiseSimilarities")
+def addPairwiseSimilarities(filename, newCellIDs, compact=False, fmt="npz"):
+    """
+    Incremental counterpart of callPairwiseSimilarites for a clique pickle updated by createCliqueDatafiles.addCellCliques:
+    adds the pairs of newCellIDs (new x old and new x new) to the existing CSV (or compact) files; missing files are written in full.
+    Returns {resultFn: (item1, item2, frequency)} arrays of the added pairs (all pairs of files written in full),
+    used to patch neighbor maps.
+    """
+    with open(filename, "rb") as f:
+        data = pickle.load(f) #Read clique data
+    typ = data["type"]
+    if compact:
+        saveCellMetadata(cellMetadataFn(typ), data)
+
+    addedPairs = {}
+    for motifName in data["clique_cells"].keys():
+        for motifLength in ["alllengths", "long"]:
+            resultFn = pairwiseResultFn(data, motifName, motifLength, compact=compact, fmt=fmt)
+            if not os.path.exists(resultFn):
+                print(f"Processing {resultFn}")
+                cellPairFrequencies = countCliquePairs(data, motifName, motifLength)
+                arrays = pairFrequenciesToArrays(cellPairFrequencies)
+                if compact:
+                    writeCompactPairs(resultFn, *arrays)
+                else:
+                    savePairwiseSimilarities(resultFn, cellPairFrequencies, data)
+                    addedPairs[resultFn] = arrays # All pairs, the file is new to cached neighbor maps
+                continue
+            print(f"Updating {resultFn}")
+            newPairFrequencies = countNewCellPairs(data, motifName, motifLength, newCellIDs)
+            newArrays = pairFrequenciesToArrays(newPairFrequencies)
+            if compact:
+                mergeCompactPairs(resultFn, *newArrays)
+            else:
+                mergePairwiseSimilarities(resultFn, newPairFrequencies, data)
+            addedPairs[resultFn] = newArrays
+    return addedPairs
+
+
+# Compact output: integer columns only, cell names and phases in a separate metadata file
+COMPACT_COLUMNS = ["Item 1", "Item 2", "Frequency"]
+COMPACT_ARRAYS = ["item1", "item2", "frequency"] # Array names in .npz files
+COMPACT_CHUNK_ROWS = 1 << 16
+PAIR_FILE_SUFFIXES = (".csv", ".csv.gz", ".npz") # Formats of pairwise similarity files
+RESULT_ROOT = "pairwiseSimilarities"
+COMPACT_RESULT_ROOT = "pairwiseSimilarities_compact" # Own root, so full CSV files and compact files never share a directory
+
+def pairwiseResultFn(data, motifName, motifLength, compact=False, fmt="npz"):
+    # pairwiseSimilarities/{motif}-{length}/... for full CSV files, pairwiseSimilarities_compact/{motif}-{length}/... for compact files
+    resultDir = os.path.join(COMPACT_RESULT_ROOT if compact else RESULT_ROOT, f"{motifName}-{motifLength}")
+    os.makedirs(resultDir, exist_ok=True)
+    return os.path.join(resultDir, f'pairwiseSimilarities-{data["type"]}-{data["chr"]}-{data["resolution"]}-{motifName}-{motifLength}.{fmt if compact else "csv"}')
+
+
+def cellMetadataFn(typ, resultRoot=COMPACT_RESULT_ROOT):
+    return os.path.join(resultRoot, f"cellMetadata-{typ}.csv")
+
+def saveCellMetadata(metaFn, data):
+    # One row per cell: Cell, cell_name, cell_phase
+    os.makedirs(os.path.dirname(metaFn) or ".", exist_ok=True)
+    cells = sorted(data["index_to_name"])
+    pd.DataFrame({"Cell": cells,
+                  "cell_name": [data["index_to_name"][cell] for cell in cells],
+                  "cell_phase": [data["index_to_type"].get(cell, "unknown") for cell in cells]}).to_csv(metaFn, index=False)
+
+@instrumentation.timed("writeCompactPairs")
+def writeCompactPairs(resultFn, item1, item2, frequency, chunkRows=COMPACT_CHUNK_ROWS):
+    """
+    Streams pair arrays (in row order, see pairFrequenciesToArrays) to resultFn in chunks of chunkRows rows.
+        .npz    - compressed, one int32 array per column (item1, item2, frequency), readable with np.load
+        .csv.gz - gzip compressed CSV with the columns Item 1, Item 2, Frequency
+    The file is written under a temporary name and renamed when complete.
+    """
+    columns = [np.asarray(column, dtype=np.int32) for column in (item1, item2, frequency)]
+    rows = len(columns[0])
+    tmpFn = f"{resultFn}.tmp"
+    if resultFn.endswith(".npz"):
+        with zipfile.ZipFile(tmpFn, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for name, column in zip(COMPACT_ARRAYS, columns):
+                with zf.open(f"{name}.npy", "w", force_zip64=True) as fp:
+                    header = {"descr": np.lib.format.dtype_to_descr(column.dtype), "fortran_order": False, "shape": (rows,)}
+                    np.lib.format.write_array_header_2_0(fp, header)
+                    for start in range(0, rows, chunkRows):
+                        fp.write(column[start:start+chunkRows].tobytes())
+    elif resultFn.endswith(".csv.gz"):
+        with gzip.open(tmpFn, "wt", newline='', compresslevel=6) as f:
+            for start in range(0, max(rows, 1), chunkRows):
+                chunk = pd.DataFrame({name: column[start:start+chunkRows] for name, column in zip(COMPACT_COLUMNS, columns)})
+                chunk.to_csv(f, header=start == 0, index=False)
+    else:
+        raise ValueError(f"Unknown compact format of {resultFn}, expected .npz or .csv.gz")
+    os.replace(tmpFn, resultFn)
+
+def readCompactPairs(resultFn, metaFn=None):
+    """
+    Reads a file written by writeCompactPairs as a DataFrame with the columns Item 1, Item 2, Frequency.
+    Cell names and phases are joined only if metaFn is given, see withCellMetadata.
+    """
+    if resultFn.endswith(".npz"):
+        with np.load(resultFn) as f:
+            df = pd.DataFrame({column: f[name] for column, name in zip(COMPACT_COLUMNS, COMPACT_ARRAYS)})
+    else:
+        df = pd.read_csv(resultFn, dtype=np.int32)
+    if metaFn is not None:
+        df = withCellMetadata(df, metaFn)
+    return df
+
+def withCellMetadata(pairs, metaFn):
+    # Adds the columns of the full CSV format (cell names, phases, same?, type) to compact pairs
+    meta = pd.read_csv(metaFn, index_col="Cell")
+    df = pairs.copy()
+    for i in [1, 2]:
+        cells = meta.reindex(df[f"Item {i}"])
+        for field in meta.columns:
+            df[f"cell{i}_{field[len('cell_'):]}"] = cells[field].to_numpy()
+    df["same?"] = df["cell1_phase"] == df["cell2_phase"]
+    df["type"] = df["cell1_phase"].astype(str) + "+" + df["cell2_phase"].astype(str)
+    return df
+
+def mergeCompactPairs(resultFn, item1, item2, frequency):
+    # Compact counterpart of mergePairwiseSimilarities: existing rows come first among equal frequencies
+    old = readCompactPairs(resultFn)
+    columns = [np.concatenate([old[column].to_numpy(), new]) for column, new in zip(COMPACT_COLUMNS, (item1, item2, frequency))]
+    order = np.argsort(-columns[2].astype(np.int64), kind="stable")
+    writeCompactPairs(resultFn, *(column[order] for column in columns))
+
+def convertToCompact(csvFn, resultFn=None, metaFn=None):
+    """
+    Converts a pairwise similarity CSV file to the compact format and optionally writes the cell metadata
+    found in its columns to metaFn. The default resultFn is the same name with .npz in a sibling directory
+    with the postfix _compact (e.g. K4_imputed_long_3.0_compact/), since a directory read by
+    runSCHiCRank.build_full_neighbor_map must hold only one file per chromosome.
+    """
+    if resultFn is None:
+        csvDir, csvName = os.path.split(os.path.abspath(csvFn))
+        resultFn = os.path.join(f"{csvDir}_compact", f"{csvName[:-len('.csv')]}.npz")
+    os.makedirs(os.path.dirname(resultFn) or ".", exist_ok=True)
+    df = pd.read_csv(csvFn)
+    writeCompactPairs(resultFn, df["Item 1"], df["Item 2"], df["Frequency"])
+    if metaFn is not None:
+        # Older files have no cell names, only the columns present are kept
+        fields = [field for field in ["name", "phase"] if f"cell1_{field}" in df.columns]
+        cells = pd.concat([df[[f"Item {i}"] + [f"cell{i}_{field}" for field in fields]].set_axis(["Cell"] + [f"cell_{field}" for field in fields], axis=1)
+                           for i in [1, 2]])
+        cells.drop_duplicates("Cell").sort_values("Cell").to_csv(metaFn, index=False)
+    return resultFn
+
+
+def pairFrequenciesToArrays(cellPairFrequencies):
+    """
+    Converts {(cell1, cell2): frequency} to integer arrays (item1, item2, frequency),
+    ordered by descending frequency exactly like the rows of the CSV files.
+    """
+    pairs = np.array(list(cellPairFrequencies.keys()), dtype=np.int64).reshape(-1, 2)
+    frequencies = np.fromiter(cellPairFrequencies.values(), dtype=np.int64, count=len(cellPairFrequencies))
+    order = np.argsort(-frequencies, kind="stable")
+    return pairs[order, 0], pairs[order, 1], frequencies[order]
 
 
+def computePairArrays(filenames, motifName="K4", motifLength="long", csvDir=None, csvWriter=None):
+    """
+    In-memory alternative to callPairwiseSimilarites for a single motif and length.
+    For each clique pickle in filenames returns {chr: (item1, item2, frequency)} integer arrays,
+    which runSCHiCRank.build_neighbor_map_from_arrays turns into a neighbor map for run_pagerank_filter.
 
+    If csvDir is given, the usual CSV files are written there as a side output (savePairArrays). Counting and
+    formatting rows are both pure Python, so the CSV files are written by a writer process, which receives only the
+    integer arrays and the cell name and type maps; on a single CPU they are written in-line instead.
+    A process executor can be passed as csvWriter to keep writing after this function returns;
+    otherwise the function waits for the CSV files before returning.
+    """
+    ownWriter = csvDir is not None and csvWriter is None and (os.cpu_count() or 1) >= 2
+    if ownWriter:
+        # Prefer fork: callers may run at module level and must not be re-imported by the writer
+        methods = multiprocessing.get_all_start_methods()
+        csvWriter = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork") if "fork" in methods else None)
+    if csvDir is not None:
+        os.makedirs(csvDir, exist_ok=True)
 
+    pairArrays = {}
+    pendingCsv = []
+    try:
+        for filename in filenames:
+            with open(filename, "rb") as f:
+                data = pickle.load(f) #Read clique data
+            print(f"Counting {motifName}-{motifLength} pairs for {data['chr']}")
+            cellPairFrequencies = countCliquePairs(data, motifName, motifLength)
+            pairArrays[data["chr"]] = pairFrequenciesToArrays(cellPairFrequencies)
 
+            if csvDir is not None:
+                resultFn = os.path.join(csvDir, f'pairwiseSimilarities-{data["type"]}-{data["chr"]}-{data["resolution"]}-{motifName}-{motifLength}.csv')
+                metaData = {"index_to_name": data["index_to_name"], "index_to_type": data["index_to_type"]}
+                if csvWriter is None:
+                    savePairArrays(resultFn, *pairArrays[data["chr"]], metaData)
+                else:
+                    pendingCsv.append(csvWriter.submit(savePairArrays, resultFn, *pairArrays[data["chr"]], metaData))
+        if ownWriter:
+            for future in pendingCsv:
+                future.result() #Re-raise errors from the writer
+    finally:
+        if ownWriter:
+            csvWriter.shutdown(wait=True)
+    return pairArrays
 
 
 if __name__ == "__main__":
@@ -0,0 +1,123 @@
+import os
+import pickle
+import numpy as np
+import pandas as pd
+import cooler
+
+
+PHASES = ["G1", "early-S", "late-S/G2", "pre-M", "post-M"]
+
+
+def create_synthetic_scool(fn="synthetic.scool",
+                           cellCount=64,
+                           contactsPerCell=4000,
+                           resolution=100000,
+                           chromosomeCount=4,
+                           chromosomeLength=40000000,
+                           motifFraction=0.3,
+                           motifsPerPhase=300,
+                           motifSize=4,
+                           maxMotifSpan=60,
+                           seed=0,
+                           cellTypeFn=None,
+                           metaFn=None):
+    """
+    Generates a synthetic single-cell .scool file that can be processed by the whole pipeline, starting
+    with `process_cells`. Each cell is assigned a phase (round robin over PHASES). Per chromosome and phase
+    there is a pool of motifs, i.e. groups of `motifSize` bins at most `maxMotifSpan` bins apart. A cell
+    contains all contacts of a random subset of its phase's motifs (about `motifFraction` of its contacts),
+    so cells of the same phase share cliques. The remaining contacts are random, with a distance decay.
+
+    Optionally it also writes the cell type file read by `process_cells` (cellTypeFn, e.g.
+    "sourceData/nagano_assoziated_cell_types.txt") and the metadata read by runSCHiCRank.py
+    (metaFn, e.g. "cellAndPhaseInfo.pkl") for the synthetic cells. Use these in a separate
+    working directory, so the files of the real dataset are not overwritten.
+
+    Parameters
+    ----------
+    fn : str
+        Path of the .scool file to create.
+    cellCount : int
+        Number of cells.
+    contactsPerCell : int
+        Approximate number of distinct contacts per cell, spread evenly over chromosomes.
+    resolution : int
+        Bin size in base pairs.
+    chromosomeCount : int
+        Number of chromosomes, named chr1, chr2, ...
+    chromosomeLength : int
+        Length of each chromosome in base pairs.
+
+    Returns
+    -------
+    dict
+        {"fn", "chromosomes", "resolution", "cell_names", "cell_phase"}
+    """
+    rng = np.random.default_rng(seed)
+    chromosomes = [f"chr{i+1}" for i in range(chromosomeCount)]
+    binsPerChr = chromosomeLength // resolution
+    bins = pd.DataFrame({
+        "chrom": np.repeat(chromosomes, binsPerChr),
+        "start": np.tile(np.arange(binsPerChr) * resolution, chromosomeCount),
+        "end": np.tile(np.arange(1, binsPerChr + 1) * resolution, chromosomeCount),
+    })
+
+    # Motif pools: motifs[chromosome index][phase] is an array (motifsPerPhase, motifSize) of local bin indices
+    motifs = []
+    for _ in chromosomes:
+        byPhase = {}
+        for phase in PHASES:
+            first = rng.integers(0, binsPerChr - maxMotifSpan, size=motifsPerPhase)
+            offsets = np.sort(rng.random((motifsPerPhase, motifSize)), axis=1) * maxMotifSpan
+            byPhase[phase] = (first[:, None] + offsets.astype(int))
+        motifs.append(byPhase)
+    motifI, motifJ = np.triu_indices(motifSize, k=1)
+
+    contactsPerChr = max(contactsPerCell // chromosomeCount, 1)
+    motifsPerChr = max(int(contactsPerChr * motifFraction) // len(motifI), 1)
+
+    cellNames = [f"Synth_{i:06d}" for i in range(cellCount)] # Zero padded, so .scool order is creation order
+    cellPhases = [PHASES[i % len(PHASES)] for i in range(cellCount)]
+    pixels = {}
+    for cellName, phase in zip(cellNames, cellPhases):
+        bin1, bin2 = [], []
+        for c, byPhase in enumerate(motifs):
+            offset = c * binsPerChr
+            chosen = byPhase[phase][rng.choice(motifsPerPhase, size=min(motifsPerChr, motifsPerPhase), replace=False)]
+            bin1.append(offset + chosen[:, motifI].ravel())
+            bin2.append(offset + chosen[:, motifJ].ravel())
+            randomCount = contactsPerChr - len(motifI) * len(chosen)
+            if randomCount > 0:
+                A = rng.integers(0, binsPerChr, size=randomCount)
+                B = np.clip(A + rng.geometric(0.05, size=randomCount), 0, binsPerChr - 1)
+                bin1.append(offset + A)
+                bin2.append(offset + B)
+        bin1, bin2 = np.concatenate(bin1), np.concatenate(bin2)
+        lo, hi = np.minimum(bin1, bin2), np.maximum(bin1, bin2)
+        pairs = np.unique(np.stack([lo, hi], axis=1), axis=0) # sorted by (bin1_id, bin2_id), duplicates removed
+        pixels[cellName] = pd.DataFrame({
+            "bin1_id": pairs[:, 0],
+            "bin2_id": pairs[:, 1],
+            "count": rng.integers(1, 4, size=len(pairs)),
+        })
+
+    if os.path.exists(fn):
+        os.remove(fn)
+    cooler.create_scool(fn, bins, pixels, ordered=True)
+
+    # Cell types in the format of nagano_assoziated_cell_types.txt
+    if cellTypeFn:
+        os.makedirs(os.path.dirname(cellTypeFn) or ".", exist_ok=True)
+        with open(cellTypeFn, "w") as f:
+            for cellName, phase in zip(cellNames, cellPhases):
+                f.write(f"/cells/{cellName}\t{phase}\n")
+    if metaFn:
+        with open(metaFn, "wb") as f:
+            pickle.dump({"cell_names": cellNames, "cell_phase": cellPhases}, f)
+
+    return {"fn": fn, "chromosomes": chromosomes, "resolution": resolution,
+            "cell_names": cellNames, "cell_phase": cellPhases}
+
+
+if __name__ == "__main__":
+    create_synthetic_scool("synthetic.scool", cellCount=64)
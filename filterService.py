@@ -0,0 +1,313 @@
+"""
+Local SCHiCRank filter service.
+
+Keeps the neighbor maps of several input directories in memory and runs filter jobs on a pool of worker
+processes, so a query costs only the filtering itself, not loading cellAndPhaseInfo.pkl and full_neighbor_map.pkl.
+The pool is forked once, at start, after the initial directories are loaded; other directories are loaded by the
+workers themselves, so a job never waits for another directory to load.
+The protocol is JSON over HTTP, on a TCP port or a Unix socket:
+
+    GET  /status                                 loaded directories and job counts
+    POST /load    {"input_dir"}                  loads a neighbor map in one worker (others load it on their first job for it)
+    POST /filter  {"input_dir", "k", "cells", "phases", "label"}
+                                                 runs run_pagerank_filter and returns its result table
+
+    # Server
+    from filterService import serve
+    serve(["K4_imputed_long_3.0"], port=8765)
+
+    # Client
+    from filterService import FilterClient
+    result = FilterClient(port=8765).filter("K4_imputed_long_3.0", k=3, phases=["G1", "early-S"])
+"""
+import io
+import os
+import json
+import time
+import socket
+import asyncio
+import contextlib
+import http.client
+import multiprocessing
+from http import HTTPStatus
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import runSCHiCRank
+
+
+DEFAULT_PORT = 8765
+
+# Neighbor maps by absolute input directory. Filled in the service process before the worker pool is started,
+# so forked workers share them; other directories are loaded by each worker on its first job and kept.
+_neighbor_maps = {}
+
+
+def get_neighbor_map(input_dir):
+    input_dir = os.path.abspath(input_dir)
+    if input_dir not in _neighbor_maps:
+        if not os.path.isdir(input_dir):
+            raise FileNotFoundError(f"Input directory {input_dir} not found")
+        with contextlib.redirect_stdout(io.StringIO()):
+            _neighbor_maps[input_dir] = runSCHiCRank.build_full_neighbor_map(input_dir)
+    return _neighbor_maps[input_dir]
+
+
+def run_filter_job(job):
+    """
+    Runs one filter job in a worker process. job is a dict with "input_dir" and optionally
+    "k", "cells" (cell IDs), "phases" (phase names; combined with "cells" as an intersection), "label" and "meta_fn".
+    Returns {"columns", "rows", "iterations", "chromosomes", "load_s", "compute_s"}; load_s is 0 unless
+    the worker loaded the directory for this job.
+    """
+    start = time.perf_counter()
+    neighbor_map = get_neighbor_map(job["input_dir"])
+    cell_phases = runSCHiCRank.load_cell_phases(job.get("meta_fn"))
+    load_s = time.perf_counter() - start
+    start = time.perf_counter()
+
+    cells = job.get("cells")
+    if job.get("phases"):
+        phases = set(job["phases"])
+        phaseCells = [cell for cell, phase in enumerate(cell_phases) if phase in phases]
+        cells = phaseCells if cells is None else sorted(set(cells) & set(phaseCells))
+    if cells is not None and len(cells) == 0:
+        raise ValueError("No cells selected")
+
+    with contextlib.redirect_stdout(io.StringIO()): # Per iteration output of run_pagerank_filter
+        df = runSCHiCRank.run_pagerank_filter(label=job.get("label", "service"), plots=False, neighbor_map=neighbor_map,
+                                              k=int(job.get("k", runSCHiCRank.K)), cells=cells, cell_phases=cell_phases, save=False)
+    return {"columns": list(df.columns), "rows": df.values.tolist(), "iterations": int(df["Iteration"].max()),
+            "chromosomes": len(neighbor_map), "load_s": load_s, "compute_s": time.perf_counter() - start}
+
+
+class RouteNotFound(LookupError):
+    pass
+
+
+def _warm_up():
+    return os.getpid()
+
+
+def _load_in_worker(input_dir):
+    # Loads a neighbor map in the worker running this job; returns (pid, chromosomes, load_s)
+    start = time.perf_counter()
+    neighbor_map = get_neighbor_map(input_dir)
+    return os.getpid(), len(neighbor_map), time.perf_counter() - start
+
+
+def _json_default(o):
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+
+class FilterService:
+    """
+    Asyncio server keeping neighbor maps resident and dispatching filter jobs to a process pool.
+    The pool is started once, before the event loop and its threads, and never replaced.
+
+    Attributes:
+    -----------
+    input_dirs : list
+        Directories whose neighbor maps are loaded at start.
+    workers : int
+        Number of worker processes (default: number of CPUs).
+    metaFn : str
+        Cell metadata used for phases, default runSCHiCRank.metaFn.
+    """
+
+    def __init__(self, input_dirs=(), workers=None, metaFn=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.metaFn = metaFn
+        self.pool = None
+        self.jobs_running = 0
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        for input_dir in input_dirs:
+            get_neighbor_map(input_dir)
+        runSCHiCRank.load_cell_phases(metaFn)
+        self.input_dirs = {d: len(m) for d, m in _neighbor_maps.items()} # Loaded in the service or by a worker
+        self._start_pool()
+
+    def _start_pool(self):
+        # A fork context lets workers inherit the loaded neighbor maps. Called from __init__ only, while the
+        # process has a single thread; forking later from the event loop's helper threads is not safe.
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        for future in [self.pool.submit(_warm_up) for _ in range(self.workers)]:
+            future.result()
+
+    async def load(self, input_dir):
+        """
+        Loads input_dir in one worker, as a job like any filter job, so the other workers keep serving jobs
+        meanwhile. The remaining workers load the directory on their first job for it (see load_s of the result).
+        """
+        input_dir = os.path.abspath(input_dir)
+        if input_dir in _neighbor_maps:
+            return {"input_dir": input_dir, "chromosomes": len(_neighbor_maps[input_dir]), "load_s": 0.0}
+        _, chromosomes, load_s = await asyncio.wrap_future(self.pool.submit(_load_in_worker, input_dir))
+        self.input_dirs[input_dir] = chromosomes
+        return {"input_dir": input_dir, "chromosomes": chromosomes, "load_s": load_s}
+
+    async def filter(self, job):
+        if not isinstance(job, dict) or "input_dir" not in job:
+            raise ValueError("input_dir is required")
+        job = dict(job, input_dir=os.path.abspath(job["input_dir"]), meta_fn=self.metaFn)
+        start = time.perf_counter()
+        self.jobs_running += 1
+        try:
+            result = await asyncio.wrap_future(self.pool.submit(run_filter_job, job))
+        except Exception:
+            self.jobs_failed += 1
+            raise
+        else:
+            self.jobs_done += 1
+        finally:
+            self.jobs_running -= 1
+        self.input_dirs.setdefault(job["input_dir"], result["chromosomes"])
+        result["latency_s"] = time.perf_counter() - start
+        return result
+
+    def status(self):
+        return {"input_dirs": dict(self.input_dirs), "workers": self.workers,
+                "jobs_running": self.jobs_running, "jobs_done": self.jobs_done, "jobs_failed": self.jobs_failed}
+
+    async def _route(self, method, path, payload):
+        if method == "GET" and path == "/status":
+            return self.status()
+        if method == "POST" and path == "/load":
+            if "input_dir" not in payload:
+                raise ValueError("input_dir is required")
+            return await self.load(payload["input_dir"])
+        if method == "POST" and path == "/filter":
+            return await self.filter(payload)
+        raise RouteNotFound(f"No route {method} {path}")
+
+    async def _handle(self, reader, writer):
+        try:
+            method, path, _ = (await reader.readline()).decode().split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode().partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            payload = json.loads(body) if body else {}
+            status, result = HTTPStatus.OK, await self._route(method, path, payload)
+        except (RouteNotFound, FileNotFoundError) as e:
+            status, result = HTTPStatus.NOT_FOUND, {"error": str(e)}
+        except (ValueError, TypeError) as e:
+            status, result = HTTPStatus.BAD_REQUEST, {"error": str(e)}
+        except Exception as e:
+            status, result = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": repr(e)}
+
+        data = json.dumps(result, default=_json_default).encode()
+        writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=DEFAULT_PORT, socket_path=None, ready=None):
+        """
+        Serves until cancelled, on socket_path if given, otherwise on host:port.
+        ready (asyncio.Event or threading.Event) is set once the server accepts connections.
+        """
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self._handle, path=socket_path)
+        else:
+            server = await asyncio.start_server(self._handle, host=host, port=port)
+        print(f"SCHiCRank filter service on {socket_path or f'{host}:{port}'} with {self.workers} workers")
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.shutdown(wait=True)
+            if socket_path is not None and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+def serve(input_dirs=(), host="127.0.0.1", port=DEFAULT_PORT, socket_path=None, workers=None, metaFn=None):
+    """
+    Loads the neighbor maps of input_dirs and serves filter jobs until interrupted.
+    """
+    service = FilterService(input_dirs, workers=workers, metaFn=metaFn)
+    try:
+        asyncio.run(service.serve(host=host, port=port, socket_path=socket_path))
+    except KeyboardInterrupt:
+        pass
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class FilterClient:
+    """
+    Client of a running FilterService, on host:port or on socket_path.
+    """
+
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, socket_path=None, timeout=None):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def _request(self, method, path, payload=None):
+        if self.socket_path is not None:
+            connection = _UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+        else:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            body = json.dumps(payload) if payload is not None else None
+            connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            result = json.loads(response.read())
+        finally:
+            connection.close()
+        if response.status != HTTPStatus.OK:
+            raise RuntimeError(f"{method} {path} failed ({response.status}): {result.get('error')}")
+        return result
+
+    def status(self):
+        return self._request("GET", "/status")
+
+    def load(self, input_dir):
+        return self._request("POST", "/load", {"input_dir": input_dir})
+
+    def filter(self, input_dir, k=runSCHiCRank.K, cells=None, phases=None, label="service"):
+        """
+        Runs run_pagerank_filter on the service. Returns a DataFrame like final_active_cells_*.csv,
+        with the service timings (load_s, compute_s, latency_s) and the number of iterations in its attrs.
+        """
+        job = {"input_dir": input_dir, "k": k, "label": label}
+        if cells is not None:
+            job["cells"] = [int(cell) for cell in cells]
+        if phases is not None:
+            job["phases"] = list(phases)
+        result = self._request("POST", "/filter", job)
+        df = pd.DataFrame(result["rows"], columns=result["columns"])
+        df.attrs.update({key: result[key] for key in ["iterations", "load_s", "compute_s", "latency_s"]})
+        return df
+
+
+if __name__ == "__main__":
+    serve(["K4_imputed_long_3.0"])
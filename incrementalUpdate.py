@@ -0,0 +1,75 @@
+import os
+import pickle
+from collections import defaultdict
+
+import instrumentation
+from processOriginalCoolDataset import add_cells, loadCellTypes
+from createCliqueDatafiles import addCellCliques
+from createPairwiseSimilarities import addPairwiseSimilarities
+from runSCHiCRank import patch_neighbor_map_cache
+
+
+def update_meta(metaFn, added, cellTypeFile):
+    """
+    Appends the added cells {cellName: cellIndex} to the cell metadata read by runSCHiCRank.py
+    ({"cell_names": [...], "cell_phase": [...]}, indexed by cell index).
+    """
+    with open(metaFn, "rb") as f:
+        meta = pickle.load(f)
+    cellTypes = loadCellTypes(cellTypeFile)
+    size = max(len(meta["cell_names"]), max(added.values()) + 1)
+    meta["cell_names"] = list(meta["cell_names"]) + [None] * (size - len(meta["cell_names"]))
+    meta["cell_phase"] = list(meta["cell_phase"]) + [None] * (size - len(meta["cell_phase"]))
+    for cellName, cellIndex in added.items():
+        meta["cell_names"][cellIndex] = cellName
+        meta["cell_phase"][cellIndex] = cellTypes.get(cellName, "unknown")
+    with open(metaFn, "wb") as f:
+        pickle.dump(meta, f)
+
+
+@instrumentation.timed("add_new_cells")
+def add_new_cells(newCellNames=None,
+                  k=10,
+                  chromosomes=["chr1", "chr2", "chr3", "chr4", "chr5", "chr6", "chr7", "chr8", "chr9", "chr10", "chr11", "chr12", "chr13", "chr14", "chr15", "chr16", "chr17", "chr18", "chr19", "chrX"],
+                  fn="sourceData/nagano_10kb_cell_types.scool",
+                  fnResolution=10000,
+                  postfix="base100k",
+                  cellTypeFile="sourceData/nagano_assoziated_cell_types.txt",
+                  metaFn="cellAndPhaseInfo.pkl",
+                  compact=False):
+    """
+    Adds new cells to an existing dataset without reprocessing the old ones:
+        1. process_cells      -> add_cells: reads only the new cells, merges their links into {postfix}-{chr}-{resolution}.pkl
+        2. createCliquePickles -> addCellCliques: enumerates cliques of the new cells only
+        3. callPairwiseSimilarites -> addPairwiseSimilarities: counts new x old and new x new pairs, merges them into the CSV files
+        4. full_neighbor_map.pkl caches of the pairwise similarity directories are patched for the affected cells
+    The cell metadata metaFn is extended with the new cells. Parameters are those of process_cells;
+    compact=True updates compact .npz pairwise similarity files instead of CSV files.
+    Returns a dict {cellName: cellIndex} of the added cells.
+    """
+    resolution = fnResolution*k
+    added = add_cells(newCellNames, k=k, chromosomes=chromosomes, fn=fn, fnResolution=fnResolution,
+                      postfix=postfix, cellTypeFile=cellTypeFile)
+    if not added:
+        return added
+    newCellIDs = sorted(added.values())
+    if metaFn and os.path.exists(metaFn):
+        update_meta(metaFn, added, cellTypeFile)
+
+    addedPairsByDir = defaultdict(dict)
+    for ch in chromosomes:
+        baseFn = f"{postfix}-{ch}-{resolution}.pkl"
+        if not os.path.exists(baseFn):
+            continue
+        cliquesFn = f"{postfix}-{ch}-{resolution}-cliques.pkl"
+        addCellCliques(baseFn, cliquesFn, newCellIDs)
+        for resultFn, arrays in addPairwiseSimilarities(cliquesFn, newCellIDs, compact=compact).items():
+            addedPairsByDir[os.path.dirname(resultFn)][os.path.basename(resultFn)] = arrays
+
+    for input_dir, addedPairs in addedPairsByDir.items():
+        patch_neighbor_map_cache(input_dir, addedPairs)
+    return added
+
+
+if __name__ == "__main__":
+    add_new_cells(k=10, fn="sourceData/nagano_10kb_cell_types.scool", postfix="base100k")
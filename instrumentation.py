@@ -0,0 +1,186 @@
+"""
+Lightweight stage-level instrumentation for the pipeline.
+
+Disabled by default; while disabled `span`, `count` and `event` return immediately. Enable it with
+`enable()` or by setting the environment variable SCHICRANK_TRACE to a .json or .csv file, in which
+case the trace is written there when the process exits.
+
+    import instrumentation
+    instrumentation.enable()
+    with instrumentation.span("my_stage", chr="chr1"):
+        ...
+    instrumentation.count("cells")
+    instrumentation.save_trace("trace.json")
+"""
+import os
+import sys
+import csv
+import json
+import time
+import atexit
+import functools
+import threading
+
+
+_enabled = False
+_events = []
+_counters = {}
+_local = threading.local()
+_origin = time.perf_counter()
+
+
+def is_enabled():
+    return _enabled
+
+def enable(traceFn=None):
+    """
+    Starts recording spans, counters and events. If traceFn is given, the trace is saved there at exit.
+    """
+    global _enabled
+    _enabled = True
+    if traceFn:
+        atexit.register(save_trace, traceFn)
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def reset():
+    # Drops all recorded events and counters
+    _events.clear()
+    _counters.clear()
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError: # Not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class _Span:
+    # Times a block and records it as an event with its duration, nesting depth and peak RSS
+    __slots__ = ("name", "fields", "start")
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        _local.depth = getattr(_local, "depth", 0) + 1
+        self.start = time.perf_counter()
+        return self
+
+    def set(self, **fields):
+        # Adds fields known only inside the block, e.g. the number of items processed
+        self.fields.update(fields)
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        _local.depth -= 1
+        record = {"type": "span", "name": self.name, "start_s": self.start - _origin, "duration_s": end - self.start,
+                  "depth": _local.depth, "peak_rss_mb": _peak_rss_mb()}
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        record.update(self.fields)
+        _events.append(record)
+        return False
+
+
+class _NoSpan:
+    # Shared do-nothing span used while instrumentation is disabled
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def set(self, **fields):
+        pass
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, **fields):
+    """
+    Context manager timing the enclosed block, e.g. `with span("pagerank", chr=ch) as s: ...; s.set(nodes=n)`.
+    """
+    if not _enabled:
+        return _NO_SPAN
+    return _Span(name, fields)
+
+def timed(name):
+    """
+    Decorator recording every call of the function as a span called `name`.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Span(name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, value=1):
+    # Increments counter `name` by value
+    if not _enabled:
+        return
+    _counters[name] = _counters.get(name, 0) + value
+
+def event(name, **fields):
+    # Records a point event with arbitrary fields, e.g. per iteration statistics
+    if not _enabled:
+        return
+    record = {"type": "event", "name": name, "start_s": time.perf_counter() - _origin}
+    record.update(fields)
+    _events.append(record)
+
+
+def get_events():
+    return list(_events)
+
+def get_counters():
+    return dict(_counters)
+
+def summary():
+    """
+    Aggregates spans by name: {name: {"calls", "total_s", "max_s"}}, sorted by total time.
+    """
+    totals = {}
+    for record in _events:
+        if record["type"] != "span":
+            continue
+        entry = totals.setdefault(record["name"], {"calls": 0, "total_s": 0.0, "max_s": 0.0})
+        entry["calls"] += 1
+        entry["total_s"] += record["duration_s"]
+        entry["max_s"] = max(entry["max_s"], record["duration_s"])
+    return dict(sorted(totals.items(), key=lambda x: -x[1]["total_s"]))
+
+def save_trace(fn):
+    """
+    Saves all recorded events to fn. A .csv file gets one row per event (columns are the union of all fields,
+    counters are added as rows of type "counter"); any other extension gets JSON with events, counters and summary.
+    """
+    if fn.endswith(".csv"):
+        rows = list(_events) + [{"type": "counter", "name": name, "value": value} for name, value in _counters.items()]
+        fieldnames = []
+        for row in rows:
+            fieldnames.extend(key for key in row if key not in fieldnames)
+        with open(fn, "w", newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(fn, "w") as f:
+            json.dump({"events": _events, "counters": _counters, "summary": summary()}, f, indent=1, default=str)
+    print(f"Trace saved to {fn}")
+
+
+if os.environ.get("SCHICRANK_TRACE"):
+    enable(os.environ["SCHICRANK_TRACE"])
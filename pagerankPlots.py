@@ -0,0 +1,115 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
+
+
+def get_phase_colors(cell_phases):
+    # One color per phase, shared by all subplots
+    return {p: matplotlib.colormaps["tab10"](i % 10) for i, p in enumerate(sorted(set(cell_phases)))}
+
+def draw_iteration_batch(fig, axes, batch, cell_phases):
+    """
+    Draws up to three iteration snapshots (iteration number, sorted pagerank values, sorted cell ids, elbow index)
+    as scatter plots colored by cell phase, with the elbow marked by a vertical line.
+    """
+    phase_colors = get_phase_colors(cell_phases)
+    for ax, (it_num, values, cell_ids, eidx) in zip(axes, batch):
+        cell_colors = [phase_colors[cell_phases[cell]] for cell in cell_ids]
+        ax.scatter(np.arange(len(values)), values, c=cell_colors, s=10)
+        if eidx is not None:
+            ax.axvline(x=eidx, color='red', linestyle='--', label=f'Elkonis pēc {eidx} šūnām')
+        ax.set_title(f"Iterācija {it_num}", fontsize=20)
+        ax.set_xlabel("Šūnas sakārtotas pēc Pagerank", fontsize=18)
+        ax.set_ylabel("PageRank vērtība", fontsize=18)
+    for ax in axes[len(batch):]:
+        ax.set_visible(False) # Last batch of a run can have fewer than three iterations
+    handles = [Line2D([0], [0], marker='o', color='w', label=phase,
+                      markerfacecolor=color, markersize=6)
+               for phase, color in phase_colors.items()]
+    fig.legend(handles=handles, title="Šūnu fāzes", loc='upper right', fontsize='large', title_fontsize='x-large')
+    fig.tight_layout()
+
+def render_iteration_batch(fn, batch, cell_phases):
+    # Renders a batch of snapshots to fn without pyplot, so it works without a display and off the main thread
+    fig = Figure(figsize=(18, 5))
+    axes = np.atleast_1d(fig.subplots(1, 3))
+    draw_iteration_batch(fig, axes, batch, cell_phases)
+    fig.savefig(fn)
+    return fn
+
+def render_elbow_curve(fn, iteration, values, elbow_index):
+    # Renders one iteration of pagerankWalkDir.py (sorted values with the elbow) to fn
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    ax.plot(np.arange(len(values)), values, marker='o')
+    if elbow_index is not None:
+        ax.axvline(x=elbow_index, color='red', linestyle='--', label=f'Elbow at {elbow_index}')
+    ax.set_title(f"Iteration {iteration} - PageRank Sum with Elbow")
+    ax.set_xlabel("Cells (sorted)")
+    ax.set_ylabel("Trimmed Sum of PageRanks")
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(fn)
+    return fn
+
+
+class PlotWriter:
+    """
+    Renders plots to files in a background process, so plotting adds no latency to the filtering loop.
+    The loop only submits lightweight snapshots; `close()` waits for all figures and re-raises rendering errors.
+    With a single CPU a concurrent renderer would compete with the loop, so rendering is deferred to `close()`.
+
+    Attributes:
+    -----------
+    plot_dir : str
+        Directory where figures are saved.
+    fmt : str
+        File format understood by matplotlib, e.g. "png" or "pdf".
+    defer : bool
+        If True, snapshots are kept until `close()` and rendered only then. Default: True on single-CPU machines.
+    """
+
+    def __init__(self, plot_dir, fmt="png", defer=None):
+        self.plot_dir = plot_dir
+        self.fmt = fmt
+        self.defer = (os.cpu_count() or 1) < 2 if defer is None else defer
+        os.makedirs(plot_dir, exist_ok=True)
+        self.executor = None
+        self.deferred = []
+        self.pending = []
+
+    def _start(self):
+        if self.executor is None:
+            # Prefer fork: scripts like pagerankWalkDir.py run at module level and must not be re-imported by the worker
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("fork") if "fork" in methods else None
+            self.executor = ProcessPoolExecutor(max_workers=1, mp_context=context)
+
+    def path(self, name):
+        return os.path.join(self.plot_dir, f"{name}.{self.fmt}")
+
+    def submit(self, render_fn, name, *args):
+        # Queue render_fn(path, *args); returns immediately
+        if self.defer:
+            self.deferred.append((render_fn, self.path(name), *args))
+            return
+        self._start()
+        self.pending.append(self.executor.submit(render_fn, self.path(name), *args))
+
+    def close(self):
+        if self.deferred:
+            self._start()
+            self.pending.extend(self.executor.submit(*job) for job in self.deferred)
+            self.deferred = []
+        try:
+            saved = [future.result() for future in self.pending]
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+        for fn in saved:
+            print(f"Plot saved to {fn}")
+        return saved
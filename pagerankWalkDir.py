@@ -3,6 +3,7 @@ import pandas as pd
 import networkx as nx
 from kneed import KneeLocator
 import matplotlib.pyplot as plt
+from pagerankPlots import PlotWriter, render_elbow_curve
 from collections import defaultdict
 import pickle
 
@@ -10,6 +11,7 @@ import pickle
 INPUT_DIR = "allResultsWithPhases/K4"
 K = 5
 MIN_ACTIVE_CELLS = 10
+PLOT_DIR = None # If set, plots are saved here by a background process instead of being shown
 
 # Helper to get all unique cell IDs from the directory
 def get_all_cells(input_dir):
@@ -56,6 +58,7 @@ inactive_info = []
 iteration = 0
 
 full_neighbor_map = build_full_neighbor_map(INPUT_DIR)
+plot_writer = PlotWriter(PLOT_DIR) if PLOT_DIR is not None else None
 
 while True:
     cell_pageranks = {cell: [] for cell in active_cells}
@@ -100,15 +103,21 @@ while True:
     active_cells = set(cell for cell, _ in sorted_cells[:elbow_index])
 
     # Plot
-    plt.figure(figsize=(10, 6))
-    plt.plot(x, values, marker='o')
-    if elbow_index is not None:
-        plt.axvline(x=elbow_index, color='red', linestyle='--', label=f'Elbow at {elbow_index}')
-    plt.title(f"Iteration {iteration} - PageRank Sum with Elbow")
-    plt.xlabel("Cells (sorted)")
-    plt.ylabel("Trimmed Sum of PageRanks")
-    plt.legend()
-    plt.tight_layout()
-    plt.show()
+    if plot_writer is not None:
+        plot_writer.submit(render_elbow_curve, f"iteration-{iteration}", iteration, values, elbow_index)
+    else:
+        plt.figure(figsize=(10, 6))
+        plt.plot(x, values, marker='o')
+        if elbow_index is not None:
+            plt.axvline(x=elbow_index, color='red', linestyle='--', label=f'Elbow at {elbow_index}')
+        plt.title(f"Iteration {iteration} - PageRank Sum with Elbow")
+        plt.xlabel("Cells (sorted)")
+        plt.ylabel("Trimmed Sum of PageRanks")
+        plt.legend()
+        plt.tight_layout()
+        plt.show()
 
     iteration += 1
+
+if plot_writer is not None:
+    plot_writer.close()
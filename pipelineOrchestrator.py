@@ -0,0 +1,363 @@
+import os
+import sys
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import hashlib
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_DIR = ".pipeline" # Manifest, hash cache, run lock and per run scratch directories, inside the working directory
+MOTIFS = [f"K{N}" for N in [3, 4, 5, 6, 7, 8]]
+MOTIF_LENGTHS = ["alllengths", "long"]
+
+
+def _code(moduleName):
+    # Source files are declared as inputs, so changing a stage's code makes its outputs stale
+    return os.path.join(REPO_DIR, f"{moduleName}.py")
+
+
+# Stage functions; they run in worker processes with the working directory as cwd
+def run_process_cells(chromosomes, scool, fnResolution, k, postfix, cellCount, cellTypeFile, scratchFn):
+    from processOriginalCoolDataset import process_cells
+    # process_cells reuses an existing cell name index; it may belong to another .scool file
+    indexFn = f"cellNameIndex_{postfix}.json"
+    if os.path.exists(indexFn):
+        os.remove(indexFn)
+    # Checkpoints go to the run's scratch directory; chromosomes not run now are kept in cellsPerInteraction_{postfix}.pkl
+    checkpointFn = os.path.join(os.path.dirname(scratchFn), f"tmpcellsPerInteraction_{postfix}.pkl")
+    process_cells(cellCount=cellCount, k=k, chromosomes=chromosomes, fn=scool, fnResolution=fnResolution,
+                  postfix=postfix, cellTypeFile=cellTypeFile, scratchFn=scratchFn, checkpointFn=checkpointFn,
+                  mergeChromosomes=True)
+
+def run_clique_pickles(baseFn, resFn):
+    from createCliqueDatafiles import createCliquePickles
+    createCliquePickles(baseFn, resFn)
+
+def run_pairwise_similarities(cliquesFn):
+    from createPairwiseSimilarities import callPairwiseSimilarites
+    callPairwiseSimilarites(cliquesFn)
+
+def run_clique_counts(cliquesFn, resFn):
+    from createCliqueCountsOverview import process_cliques
+    process_cliques(cliquesFn, resFn)
+
+def run_filter(csvFns, label, metaFn):
+    # Neighbor map from the declared CSV files only; full_neighbor_map.pkl in the directory may be stale
+    import pandas as pd
+    from runSCHiCRank import build_neighbor_dict, load_cell_phases, run_pagerank_filter
+    neighbor_map = {}
+    for fn in csvFns:
+        df = pd.read_csv(fn, usecols=["Item 1", "Item 2", "Frequency"])
+        neighbor_map[os.path.basename(fn)] = build_neighbor_dict(df["Item 1"].to_numpy(), df["Item 2"].to_numpy(), df["Frequency"].to_numpy())
+    run_pagerank_filter(label=label, plots=False, neighbor_map=neighbor_map, cell_phases=load_cell_phases(metaFn))
+
+def _execute(workDir, fn, kwargs):
+    os.chdir(workDir)
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    fn(**kwargs)
+
+
+class Task:
+    """
+    One node of the pipeline DAG.
+
+    Attributes:
+    -----------
+    name : str
+        Unique task name, e.g. "cliques:chr18".
+    fn : callable
+        Top level stage function, called as fn(**kwargs) in a worker process.
+    kwargs : dict
+        Arguments of fn. Together with the hashes of the inputs they form the task's fingerprint.
+    inputs : list
+        Files read by the task. Paths relative to the working directory or absolute.
+    outputs : list
+        Files the task must produce.
+    sharedOutputs : list
+        Files written by several tasks (e.g. every task of a batch). They must exist after the task and
+        for it to be up to date, but their content is not compared, since other tasks change it.
+    deps : list
+        Names of tasks that must finish first.
+    batch : str or None
+        Stale tasks with the same batch are run as one call of fn, with the union of their
+        "chromosomes" arguments (used for process_cells, which reads every cell once for all chromosomes).
+    scratch : bool
+        If True, fn gets a "scratchFn" argument: a .cool file path private to the current run.
+    """
+
+    def __init__(self, name, fn, kwargs, inputs, outputs, deps=(), batch=None, scratch=False, sharedOutputs=()):
+        self.name = name
+        self.fn = fn
+        self.kwargs = kwargs
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.sharedOutputs = list(sharedOutputs)
+        self.deps = list(deps)
+        self.batch = batch
+        self.scratch = scratch
+
+
+def build_pipeline(scool="sourceData/nagano_10kb_cell_types.scool",
+                   chromosomes=["chr1", "chr2", "chr3", "chr4", "chr5", "chr6", "chr7", "chr8", "chr9", "chr10", "chr11", "chr12", "chr13", "chr14", "chr15", "chr16", "chr17", "chr18", "chr19", "chrX"],
+                   fnResolution=10000,
+                   k=10,
+                   postfix="base100k",
+                   cellCount=None,
+                   cellTypeFile="sourceData/nagano_assoziated_cell_types.txt",
+                   motif="K4-long",
+                   label=None,
+                   metaFn="cellAndPhaseInfo.pkl"):
+    """
+    Builds the task DAG of the whole pipeline with the file names used by the individual scripts:
+    process_cells -> createCliquePickles -> callPairwiseSimilarites -> run_pagerank_filter (on `motif`),
+    and createCliquePickles -> process_cliques. Every stage except the final filter is split per chromosome.
+    """
+    resolution = fnResolution * k
+    label = label or f"{postfix}_{motif}"
+    tasks = []
+    filterInputs = []
+    for ch in chromosomes:
+        baseFn = f"{postfix}-{ch}-{resolution}.pkl"
+        cliquesFn = f"{postfix}-{ch}-{resolution}-cliques.pkl"
+        pairwiseFns = [f"pairwiseSimilarities/{m}-{length}/pairwiseSimilarities-{postfix}_cliques-{ch}-{resolution}-{m}-{length}.csv"
+                       for m in MOTIFS for length in MOTIF_LENGTHS]
+        tasks.append(Task(f"process_cells:{ch}", run_process_cells,
+                          {"chromosomes": [ch], "scool": scool, "fnResolution": fnResolution, "k": k, "postfix": postfix,
+                           "cellCount": cellCount, "cellTypeFile": cellTypeFile},
+                          inputs=[scool, cellTypeFile, _code("processOriginalCoolDataset"), _code("MulticoolProcessor"), _code("CoolProcessor")],
+                          outputs=[baseFn], batch="process_cells", scratch=True,
+                          sharedOutputs=[f"cellNameIndex_{postfix}.json", f"cellsPerInteraction_{postfix}.pkl"]))
+        tasks.append(Task(f"cliques:{ch}", run_clique_pickles, {"baseFn": baseFn, "resFn": cliquesFn},
+                          inputs=[baseFn, _code("createCliqueDatafiles")], outputs=[cliquesFn], deps=[f"process_cells:{ch}"]))
+        tasks.append(Task(f"pairwise:{ch}", run_pairwise_similarities, {"cliquesFn": cliquesFn},
+                          inputs=[cliquesFn, _code("createPairwiseSimilarities")], outputs=pairwiseFns, deps=[f"cliques:{ch}"]))
+        tasks.append(Task(f"cliqueCounts:{ch}", run_clique_counts, {"cliquesFn": cliquesFn, "resFn": f"all_cliques_data_{ch}_{postfix}.csv"},
+                          inputs=[cliquesFn, _code("createCliqueCountsOverview")], outputs=[f"all_cliques_data_{ch}_{postfix}.csv"],
+                          deps=[f"cliques:{ch}"]))
+        filterInputs.append(f"pairwiseSimilarities/{motif}/pairwiseSimilarities-{postfix}_cliques-{ch}-{resolution}-{motif}.csv")
+
+    tasks.append(Task("filter", run_filter, {"csvFns": filterInputs, "label": label, "metaFn": metaFn},
+                      inputs=filterInputs + [metaFn, _code("runSCHiCRank")], outputs=[f"final_active_cells_{label}.csv"],
+                      deps=[f"pairwise:{ch}" for ch in chromosomes]))
+    return tasks
+
+
+class PipelineOrchestrator:
+    """
+    Runs a DAG of Tasks in a working directory and skips tasks whose outputs are up to date.
+
+    A task's fingerprint is the SHA-256 of its name, arguments and the content hashes of its inputs.
+    After a successful run the fingerprint and output hashes are stored in .pipeline/manifest.json; a task is
+    up to date if its fingerprint is unchanged and all outputs still have the recorded content.
+    Independent tasks (e.g. different chromosomes) run concurrently in a process pool. Every run gets its own
+    scratch directory under .pipeline/scratch for files such as tmp.cool. Runs in the same working directory
+    write the same outputs, manifest and cell name index, so a run holds .pipeline/lock and later runs wait for it.
+    """
+
+    def __init__(self, tasks, workDir=".", maxWorkers=None):
+        self.tasks = {task.name: task for task in tasks}
+        self.workDir = os.path.abspath(workDir)
+        self.maxWorkers = maxWorkers
+        self.stateDir = os.path.join(self.workDir, STATE_DIR)
+        os.makedirs(self.stateDir, exist_ok=True)
+        self.manifestFn = os.path.join(self.stateDir, "manifest.json")
+        self.hashCacheFn = os.path.join(self.stateDir, "hashes.json")
+        self.lockFn = os.path.join(self.stateDir, "lock")
+        self.manifest = self._load(self.manifestFn)
+        self.hashCache = self._load(self.hashCacheFn)
+        for task in tasks:
+            missing = [dep for dep in task.deps if dep not in self.tasks]
+            if missing:
+                raise ValueError(f"Task {task.name} depends on unknown tasks {missing}")
+
+    @staticmethod
+    def _load(fn):
+        if os.path.exists(fn):
+            with open(fn) as f:
+                return json.load(f)
+        return {}
+
+    @staticmethod
+    def _save(fn, obj):
+        # Write and rename, so an interrupted run never leaves a truncated manifest
+        tmpFn = f"{fn}.{os.getpid()}.tmp"
+        with open(tmpFn, "w") as f:
+            json.dump(obj, f, indent=1)
+        os.replace(tmpFn, fn)
+
+    def _path(self, fn):
+        return fn if os.path.isabs(fn) else os.path.join(self.workDir, fn)
+
+    def file_hash(self, fn):
+        # SHA-256 of the file content; cached by size and modification time, so unchanged files are not reread
+        path = self._path(fn)
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        key = f"{stat.st_size}:{stat.st_mtime_ns}"
+        cached = self.hashCache.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        self.hashCache[path] = [key, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def fingerprint(self, task):
+        inputs = {fn: self.file_hash(fn) for fn in task.inputs}
+        payload = json.dumps({"task": task.name, "kwargs": task.kwargs, "inputs": inputs}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def is_up_to_date(self, task, fingerprint=None):
+        record = self.manifest.get(task.name)
+        if fingerprint is None:
+            fingerprint = self.fingerprint(task)
+        if record is None or record["fingerprint"] != fingerprint:
+            return False
+        if any(not os.path.exists(self._path(fn)) for fn in task.sharedOutputs):
+            return False
+        return all(self.file_hash(fn) is not None and self.file_hash(fn) == record["outputs"].get(fn) for fn in task.outputs)
+
+    def status(self):
+        """
+        Returns {task name: "up-to-date" | "stale" | "waiting"} without running anything.
+        "waiting" tasks depend on stale tasks, so they will run after them.
+        """
+        result = {}
+        for name in self._topological_order():
+            task = self.tasks[name]
+            if any(result[dep] != "up-to-date" for dep in task.deps):
+                result[name] = "waiting"
+            else:
+                result[name] = "up-to-date" if self.is_up_to_date(task) else "stale"
+        return result
+
+    def _topological_order(self):
+        order, visited = [], set()
+        def visit(name, stack=()):
+            if name in visited:
+                return
+            if name in stack:
+                raise ValueError(f"Cycle in pipeline at task {name}")
+            for dep in self.tasks[name].deps:
+                visit(dep, stack + (name,))
+            visited.add(name)
+            order.append(name)
+        for name in self.tasks:
+            visit(name)
+        return order
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # Exclusive lock on the working directory for the duration of a run
+        with open(self.lockFn, "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print(f"Waiting for another pipeline run in {self.workDir}")
+                start = time.perf_counter()
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                print(f"Waited {time.perf_counter() - start:.1f} s")
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _record(self, task, fingerprint):
+        missing = [fn for fn in task.outputs + task.sharedOutputs if not os.path.exists(self._path(fn))]
+        if missing:
+            raise RuntimeError(f"Task {task.name} did not produce {missing}")
+        self.manifest[task.name] = {"fingerprint": fingerprint, "outputs": {fn: self.file_hash(fn) for fn in task.outputs}}
+        self._save(self.manifestFn, self.manifest)
+
+    def run(self):
+        """
+        Runs all stale tasks in dependency order, concurrently where possible.
+        Returns {"ran": [...], "skipped": [...], "failed": {name: error}}; tasks depending on a failed task are not run.
+        Waits until other runs in the same working directory have finished.
+        """
+        with self._locked():
+            # Another run may have updated the manifest since it was loaded
+            self.manifest = self._load(self.manifestFn)
+            self.hashCache = self._load(self.hashCacheFn)
+            return self._run()
+
+    def _run(self):
+        runId = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        scratchDir = os.path.join(self.stateDir, "scratch", runId)
+        os.makedirs(scratchDir)
+        done, ran, skipped, failed = set(), [], [], {}
+        running = {} # future -> (tasks, fingerprints)
+        remaining = self._topological_order()
+
+        try:
+            with ProcessPoolExecutor(max_workers=self.maxWorkers) as executor:
+                while remaining or running:
+                    # Schedule all tasks whose dependencies are done; batch tasks are merged into one call
+                    ready = [name for name in remaining if all(dep in done for dep in self.tasks[name].deps)]
+                    # Tasks behind a failure fail too, including dependents of dependents
+                    blocked = [name for name in remaining if any(dep in failed for dep in self.tasks[name].deps)]
+                    while blocked:
+                        for name in blocked:
+                            failed[name] = "dependency failed"
+                            remaining.remove(name)
+                        blocked = [name for name in remaining if any(dep in failed for dep in self.tasks[name].deps)]
+                    batches = {}
+                    for name in ready:
+                        remaining.remove(name)
+                        task = self.tasks[name]
+                        fingerprint = self.fingerprint(task)
+                        if self.is_up_to_date(task, fingerprint):
+                            done.add(name)
+                            skipped.append(name)
+                            continue
+                        if task.batch is None:
+                            batches[name] = [(task, fingerprint)]
+                        else:
+                            batches.setdefault(task.batch, []).append((task, fingerprint))
+                    for members in batches.values():
+                        first = members[0][0]
+                        kwargs = dict(first.kwargs)
+                        if first.batch is not None:
+                            kwargs["chromosomes"] = [ch for task, _ in members for ch in task.kwargs["chromosomes"]]
+                        if first.scratch:
+                            kwargs["scratchFn"] = os.path.join(scratchDir, f"{first.name.replace(':', '_')}.cool")
+                        print(f"Running {', '.join(task.name for task, _ in members)}")
+                        running[executor.submit(_execute, self.workDir, first.fn, kwargs)] = members
+                    if not running:
+                        if remaining and not ready:
+                            break # Tasks with unsatisfiable dependencies, none are left after failures
+                        continue
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        members = running.pop(future)
+                        try:
+                            future.result()
+                            for task, fingerprint in members:
+                                self._record(task, fingerprint)
+                                done.add(task.name)
+                                ran.append(task.name)
+                        except Exception as e:
+                            for task, _ in members:
+                                failed[task.name] = repr(e)
+                                print(f"Task {task.name} failed: {e!r}")
+        finally:
+            shutil.rmtree(scratchDir, ignore_errors=True)
+            self._save(self.hashCacheFn, self.hashCache)
+
+        print(f"Pipeline finished: {len(ran)} ran, {len(skipped)} up to date, {len(failed)} failed")
+        return {"ran": ran, "skipped": skipped, "failed": failed}
+
+
+if __name__ == "__main__":
+    tasks = build_pipeline(scool="sourceData/nagano_10kb_cell_types.scool", k=10, postfix="base100k", motif="K4-long")
+    PipelineOrchestrator(tasks, workDir=".").run()
@@ -5,6 +5,7 @@ import os
 import json
 import pickle
 import csv
+import instrumentation
 
 
 def combineDicts(d1, d2):
@@ -25,18 +26,53 @@ def combineDicts(d1, d2):
     return d3
 
 
+def loadCellTypes(cellTypeFile):
+    # {cellName: cellType} from a tab separated file such as nagano_assoziated_cell_types.txt
+    cellTypeMapping = {}
+    
+    if os.path.exists(cellTypeFile):
+        with open(cellTypeFile, "r", newline='') as f:
+            reader = csv.reader(f, delimiter='\t')
+            for row in reader:
+                if len(row) == 2:
+                    cellName, cellType = row
+                    cellName = cellName.lstrip("/cells/")
+                    cellTypeMapping[cellName] = cellType
+    else:
+        logging.warning(f"Cell type file {cellTypeFile} not found. For example dataset download nagano_assoziated_cell_types.txt from https://zenodo.org/records/4308298")
+    return cellTypeMapping
+
+
+def readCellLinks(M, cellName, chromosomes, k=1, scratchFn="tmp.cool"):
+    # Reads one cell and returns {chr: [(A, B), ...]} of its links (contacts without self loops) for chromosomes with data
+    C = M.readCell(cellName=cellName)
+    if k > 1:
+        C = C.reduceResolution(k, fn=scratchFn)
 
+    cellLinks = {}
+    for ch in chromosomes:  # Process specific chromosome(s)
+        if not C.hasDataOnChr(ch):
+            continue
+        chrInteractions = C.getAllInteractionsWithLoci(ch=ch)
+        cellLinks[ch] = [(A, B) for (A, B, count) in chrInteractions if A != B]
+    return cellLinks
+
+
+@instrumentation.timed("process_cells")
 def process_cells(cellCount = None, k=1, 
                   chromosomes = ["chr1", "chr2", "chr3", "chr4", "chr5", "chr6", "chr7", "chr8", "chr9", "chr10", "chr11", "chr12", "chr13", "chr14", "chr15", "chr16", "chr17", "chr18", "chr19", "chrX"], 
                   fn="sourceData/nagano_10kb_cell_types.scool", 
                   fnResolution = 10000,
-                  postfix="base10k"):
+                  postfix="base10k",
+                  cellTypeFile = "sourceData/nagano_assoziated_cell_types.txt",
+                  scratchFn = "tmp.cool",
+                  checkpointFn = None,
+                  mergeChromosomes = False):
     
-    cellTypeFile = "sourceData/nagano_assoziated_cell_types.txt"
     resolution = fnResolution*k
     cellNamesToIndexFn = f"cellNameIndex_{postfix}.json"
     resFn = f"cellsPerInteraction_{postfix}"
-    tmpresFn = f"tmpcellsPerInteraction_{postfix}"
+    checkpointFn = checkpointFn or f"tmpcellsPerInteraction_{postfix}.pkl"
 
     # Set up logging
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -65,18 +101,7 @@ def process_cells(cellCount = None, k=1,
         cellNames = cellNames[:cellCount]
 
     # Load cell type mapping from file
-    cellTypeMapping = {}
-    
-    if os.path.exists(cellTypeFile):
-        with open(cellTypeFile, "r", newline='') as f:
-            reader = csv.reader(f, delimiter='\t')
-            for row in reader:
-                if len(row) == 2:
-                    cellName, cellType = row
-                    cellName = cellName.lstrip("/cells/")
-                    cellTypeMapping[cellName] = cellType
-    else:
-        logging.warning(f"Cell type file {cellTypeFile} not found. For example dataset download nagano_assoziated_cell_types.txt from https://zenodo.org/records/4308298")
+    cellTypeMapping = loadCellTypes(cellTypeFile)
 
     # Create index to type mapping
     indexToType = {}
@@ -100,48 +125,57 @@ def process_cells(cellCount = None, k=1,
 
         logging.info(f"Processing cell {i}: {cellName}")
         try:
-            # Process the cell
-            cell_index = cellNamesToIndex[cellName]
-            C = M.readCell(cellName=cellName)
-            if k > 1:
-                C = C.reduceResolution(k, fn="tmp.cool")
+            with instrumentation.span("process_cells.cell", cell=cellName) as cellSpan:
+                # Process the cell
+                cell_index = cellNamesToIndex[cellName]
 
-            for ch in chromosomes:  # Process specific chromosome(s)
-                if not C.hasDataOnChr(ch):
-                    continue
-                chrInteractions = C.getAllInteractionsWithLoci(ch=ch)
+                cellLinks = 0
+                for ch, links in readCellLinks(M, cellName, chromosomes, k, scratchFn).items():
+                    if ch not in cellsPerInteractionIncrement:
+                        cellsPerInteractionIncrement[ch] = defaultdict(list)
 
-                if ch not in cellsPerInteractionIncrement:
-                    cellsPerInteractionIncrement[ch] = defaultdict(list)
-
-                for (A, B, count) in chrInteractions:
-                    if A==B:
-                        continue
-                    cellsPerInteractionIncrement[ch][(A, B)].append(cell_index)
+                    for (A, B) in links:
+                        cellsPerInteractionIncrement[ch][(A, B)].append(cell_index)
+                    cellLinks += len(links)
+                cellSpan.set(links=cellLinks)
 
             # Mark cell as processed
             alreadyProcessedCells.add(cellName)
+            instrumentation.count("process_cells.cells")
+            instrumentation.count("process_cells.links", cellLinks)
         except Exception as e:
             logging.error(f"Error processing cell {cellName}: {e}", exc_info=True)
+            instrumentation.count("process_cells.errors")
         
         if ((i+1)%16)==0:
-            cellsPerInteractionFull = combineDicts(cellsPerInteractionFull, cellsPerInteractionIncrement)
+            with instrumentation.span("process_cells.combine", cells=i+1):
+                cellsPerInteractionFull = combineDicts(cellsPerInteractionFull, cellsPerInteractionIncrement)
             cellsPerInteractionIncrement = defaultdict(dict)
             logging.info(f"Processed {i+1} cells.") 
             if ((i+1)%64)==0:
                 logging.info("Saving processed cells.")
-                with open(f"{tmpresFn}.pkl", 'wb') as f:
+                with open(checkpointFn, 'wb') as f:
                     pickle.dump(cellsPerInteractionFull, f)
                 logging.info("Processed cells saved.")
 
         
         
 
-    cellsPerInteractionFull = combineDicts(cellsPerInteractionFull, cellsPerInteractionIncrement)
+    with instrumentation.span("process_cells.combine", cells=len(cellNames)):
+        cellsPerInteractionFull = combineDicts(cellsPerInteractionFull, cellsPerInteractionIncrement)
     logging.info("Processing completed.")
     logging.info("Saving processed cells.")
-    with open(f"{resFn}.pkl", 'wb') as f:
-        pickle.dump(cellsPerInteractionFull, f)
+    cellsPerInteractionSaved = cellsPerInteractionFull
+    if mergeChromosomes and os.path.exists(f"{resFn}.pkl"):
+        # Keep the other chromosomes of an earlier run, e.g. when only some chromosomes are reprocessed
+        with open(f"{resFn}.pkl", 'rb') as f:
+            cellsPerInteractionSaved = pickle.load(f)
+        for ch in chromosomes:
+            cellsPerInteractionSaved.pop(ch, None)
+        cellsPerInteractionSaved.update(cellsPerInteractionFull)
+    with open(f"{resFn}.pkl.tmp", 'wb') as f:
+        pickle.dump(cellsPerInteractionSaved, f)
+    os.replace(f"{resFn}.pkl.tmp", f"{resFn}.pkl")
 
     # 
     for cch, dictOfLinkCells in cellsPerInteractionFull.items():
@@ -172,6 +206,113 @@ def process_cells(cellCount = None, k=1,
             pickle.dump(finalData, f)
 
 
+@instrumentation.timed("add_cells")
+def add_cells(newCellNames = None, k=1,
+              chromosomes = ["chr1", "chr2", "chr3", "chr4", "chr5", "chr6", "chr7", "chr8", "chr9", "chr10", "chr11", "chr12", "chr13", "chr14", "chr15", "chr16", "chr17", "chr18", "chr19", "chrX"],
+              fn="sourceData/nagano_10kb_cell_types.scool",
+              fnResolution = 10000,
+              postfix="base10k",
+              cellTypeFile = "sourceData/nagano_assoziated_cell_types.txt",
+              scratchFn = "tmp.cool"):
+    """
+    Incremental counterpart of process_cells: reads only new cells and merges their links into the existing
+    per-chromosome files {postfix}-{chr}-{resolution}.pkl and cellsPerInteraction_{postfix}.pkl.
+
+    By default the new cells are all cells of the .scool file missing from cellNameIndex_{postfix}.json.
+    They get the next free indices, existing indices never change. newCellNames can list cells explicitly;
+    cells that already have links in the per-chromosome files are skipped.
+
+    Returns a dict {cellName: cellIndex} of the cells added.
+    """
+    resolution = fnResolution*k
+    cellNamesToIndexFn = f"cellNameIndex_{postfix}.json"
+    resFn = f"cellsPerInteraction_{postfix}"
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    M = MulticoolProcessor(fn)
+    cellNamesToIndex = {}
+    if os.path.exists(cellNamesToIndexFn):
+        with open(cellNamesToIndexFn, 'r') as f:
+            cellNamesToIndex = json.load(f)
+
+    # Existing per-chromosome link data
+    linkData = {}
+    for ch in chromosomes:
+        finalFn = f"{postfix}-{ch}-{resolution}.pkl"
+        if os.path.exists(finalFn):
+            with open(finalFn, 'rb') as f:
+                linkData[ch] = pickle.load(f)
+    processedCells = {cellIndex for data in linkData.values() for cellIndex in data["cell_links"]}
+
+    if newCellNames is None:
+        newCellNames = [cellName for cellName in M.getCellNames() if cellName not in cellNamesToIndex]
+    nextIndex = max(cellNamesToIndex.values(), default=-1) + 1
+    added = {}
+    for cellName in newCellNames:
+        if cellName not in cellNamesToIndex:
+            cellNamesToIndex[cellName] = nextIndex
+            nextIndex += 1
+        if cellNamesToIndex[cellName] in processedCells:
+            logging.info(f"Skipping already processed cell {cellName}")
+            continue
+        added[cellName] = cellNamesToIndex[cellName]
+    if not added:
+        logging.info("No new cells to add.")
+        return added
+
+    cellTypeMapping = loadCellTypes(cellTypeFile)
+    indexToName = {v: k for k, v in cellNamesToIndex.items()}
+    indexToType = {cellID: cellTypeMapping.get(cellName, "unknown") for cellName, cellID in cellNamesToIndex.items()}
+
+    # Read only the new cells
+    newLinks = defaultdict(dict) # {chr: {cellIndex: [(A, B), ...]}}
+    for i, (cellName, cell_index) in enumerate(added.items()):
+        logging.info(f"Processing new cell {i}: {cellName}")
+        try:
+            with instrumentation.span("add_cells.cell", cell=cellName) as cellSpan:
+                cellLinks = readCellLinks(M, cellName, chromosomes, k, scratchFn)
+                for ch, links in cellLinks.items():
+                    newLinks[ch][cell_index] = links
+                cellSpan.set(links=sum(len(links) for links in cellLinks.values()))
+            instrumentation.count("add_cells.cells")
+        except Exception as e:
+            logging.error(f"Error processing cell {cellName}: {e}", exc_info=True)
+            instrumentation.count("add_cells.errors")
+
+    # Merge into the per-chromosome files
+    cellIDs = sorted(cellNamesToIndex.values())
+    for ch in set(linkData) | set(newLinks):
+        data = linkData.get(ch) or {"chr": ch, "type": postfix, "resolution": resolution, "cell_links": {}, "link_cells": {}}
+        data.update({"index_to_name": indexToName, "index_to_type": indexToType, "cell_IDs": cellIDs})
+        for cell_index, links in newLinks.get(ch, {}).items():
+            links = sorted({(int(A), int(B)) for (A, B) in links})
+            if not links:
+                continue
+            data["cell_links"][cell_index] = links
+            for link in links:
+                data["link_cells"][link] = sorted(set(data["link_cells"].get(link, [])) | {cell_index})
+        with open(f"{postfix}-{ch}-{resolution}.pkl", 'wb') as f:
+            pickle.dump(data, f)
+
+    if os.path.exists(f"{resFn}.pkl"):
+        with open(f"{resFn}.pkl", 'rb') as f:
+            cellsPerInteractionFull = pickle.load(f)
+        for ch, byCell in newLinks.items():
+            if ch not in cellsPerInteractionFull:
+                cellsPerInteractionFull[ch] = defaultdict(list)
+            for cell_index, links in byCell.items():
+                for (A, B) in links:
+                    cellsPerInteractionFull[ch].setdefault((A, B), []).append(cell_index)
+        with open(f"{resFn}.pkl", 'wb') as f:
+            pickle.dump(cellsPerInteractionFull, f)
+
+    with open(cellNamesToIndexFn, 'w') as f:
+        json.dump(cellNamesToIndex, f)
+    logging.info(f"Added {len(added)} cells.")
+    return added
+
+
 if __name__ == "__main__":
     process_cells(cellCount=None, k=10, 
                   chromosomes=["chr1", "chr2", "chr3", "chr4", "chr5", "chr6", "chr7", "chr8", "chr9", "chr10", "chr11", "chr12", "chr13", "chr14", "chr15", "chr16", "chr17", "chr18", "chr19", "chrX"],
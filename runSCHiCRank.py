@@ -1,37 +1,128 @@
 import os
+import time
+import math
+import heapq
+import numpy as np
 import pandas as pd
 import networkx as nx
-from kneed import KneeLocator
 import matplotlib.pyplot as plt
+from pagerankPlots import PlotWriter, draw_iteration_batch, render_iteration_batch
 from collections import defaultdict
 import pickle
+import instrumentation
+from createPairwiseSimilarities import PAIR_FILE_SUFFIXES, readCompactPairs
 
 
 # Configuration
 K = 5 # Number of top neighbors to consider for each cell
 MIN_ACTIVE_CELLS = 10 # Minimum number of active cells to keep in the analysis
 
-# Load cell phase metadata (global)
+# Cell phase metadata, loaded on first use
 metaFn = "cellAndPhaseInfo.pkl"
-with open(metaFn, "rb") as f:
-    meta = pickle.load(f)
-    cell_phases = meta["cell_phase"]
+_cell_phases_cache = {}
+
+def load_cell_phases(fn=None):
+    """
+    Returns the list of cell phases (indexed by cell ID) from the metadata pickle fn (default metaFn).
+    The list is read once and cached until the file changes.
+    """
+    fn = fn or metaFn
+    key = (os.path.abspath(fn), os.path.getmtime(fn))
+    if key not in _cell_phases_cache:
+        with open(fn, "rb") as f:
+            meta = pickle.load(f)
+        _cell_phases_cache.clear()
+        _cell_phases_cache[key] = meta["cell_phase"]
+    return _cell_phases_cache[key]
+
+def __getattr__(name):
+    # Keeps `runSCHiCRank.cell_phases` working without reading the metadata at import time
+    if name == "cell_phases":
+        return load_cell_phases()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
+# Pairwise similarity files: full CSV or compact (see createPairwiseSimilarities.writeCompactPairs)
+def read_pair_file(fn):
+    if fn.endswith(".csv"):
+        return pd.read_csv(fn, usecols=["Item 1", "Item 2", "Frequency"])
+    return readCompactPairs(fn)
+
+def pair_file_stem(file):
+    # File name without the format suffix, one stem per chromosome
+    for suffix in PAIR_FILE_SUFFIXES:
+        if file.endswith(suffix):
+            return file[:-len(suffix)]
+    return None
+
+def pair_files(input_dir):
+    """
+    Pairwise similarity files of input_dir, in directory order. Raises ValueError if a chromosome is stored
+    in more than one format, which would otherwise be counted several times.
+    """
+    files, stems = [], {}
+    for file in os.listdir(input_dir):
+        stem = pair_file_stem(file)
+        if stem is None:
+            continue
+        if stem in stems:
+            raise ValueError(f"{input_dir} contains {stems[stem]} and {file} for the same chromosome, remove one of them")
+        stems[stem] = file
+        files.append(file)
+    return files
+
 # Helper to get all unique cell IDs from the directory
 def get_all_cells(input_dir):
     cell_ids = set()
-    for file in os.listdir(input_dir):
-        if file.endswith(".csv"):
-            df = pd.read_csv(os.path.join(input_dir, file))
-            cell_ids.update(df["Item 1"].unique())
-            cell_ids.update(df["Item 2"].unique())
+    for file in pair_files(input_dir):
+        df = read_pair_file(os.path.join(input_dir, file))
+        cell_ids.update(df["Item 1"].unique())
+        cell_ids.update(df["Item 2"].unique())
     return cell_ids
 
+# Helper to build one chromosome's neighbor dict from pair arrays
+def build_neighbor_dict(item1, item2, freq):
+    """
+    Builds the neighbor dict of one chromosome from integer arrays of cell pairs and their frequencies,
+    in the row order of the pairwise similarity CSV files (descending frequency).
+    Returns a defaultdict(list) mapping each cell to a list of tuples (neighbor, frequency), sorted by
+    descending frequency; ties keep the row order, same as building it row by row.
+    """
+    item1, item2, freq = np.asarray(item1), np.asarray(item2), np.asarray(freq)
+    # Interleave both directions of every pair so that entries of each cell stay in row order
+    src = np.column_stack([item1, item2]).ravel()
+    dst = np.column_stack([item2, item1]).ravel()
+    weights = np.repeat(freq, 2)
+    order = np.lexsort((-weights, src)) # stable: by cell, then descending frequency, then row order
+    src, dst, weights = src[order], dst[order], weights[order]
+
+    neighbor_dict = defaultdict(list)
+    if len(src) == 0:
+        return neighbor_dict
+    boundaries = np.flatnonzero(np.diff(src)) + 1
+    starts = np.concatenate([[0], boundaries]).tolist()
+    ends = np.concatenate([boundaries, [len(src)]]).tolist()
+    cells, dst, weights = src[starts].tolist(), dst.tolist(), weights.tolist()
+    for cell, start, end in zip(cells, starts, ends):
+        neighbor_dict[cell] = list(zip(dst[start:end], weights[start:end]))
+    return neighbor_dict
+
+# Helper to build a neighbor map directly from in-memory pair arrays
+def build_neighbor_map_from_arrays(pair_arrays):
+    """
+    Builds a neighbor map from {key: (item1, item2, frequency)} arrays, e.g. as returned by
+    createPairwiseSimilarities.computePairArrays, without writing or parsing CSV files.
+    The result has the same structure as build_full_neighbor_map and can be passed to run_pagerank_filter.
+    """
+    return {key: build_neighbor_dict(*arrays) for key, arrays in pair_arrays.items()}
+
 # Helper to build a master neighbor map for all files
+@instrumentation.timed("build_full_neighbor_map")
 def build_full_neighbor_map(input_dir):
     """
     Builds or loads a full neighbor map from CSV files in the specified input directory.
+    Compact files (.npz or .csv.gz, see createPairwiseSimilarities.writeCompactPairs) are read as well;
+    a chromosome stored in more than one format raises ValueError, see pair_files.
     This function processes all CSV files in the given directory, where each file contains
     pairwise relationships (e.g., between genomic loci or cells) and their associated frequencies.
     For each item, it constructs a dictionary mapping each entity to its neighbors, sorted by frequency.
@@ -61,31 +152,154 @@ def build_full_neighbor_map(input_dir):
     #Otherwise, compute the top neighbours for each cell
     print("Building full neighbor map...")
     full_neighbor_map = dict()
-    for file in os.listdir(input_dir):
+    for file in pair_files(input_dir):
         #File has data for one chromsome
-        if not file.endswith(".csv"):
-            continue
         print(f"Processing {file}...")
-        df = pd.read_csv(os.path.join(input_dir, file))
-        neighbor_dict = defaultdict(list)
-        for _, row in df.iterrows():
-            a, b = row["Item 1"], row["Item 2"]
-            freq = row["Frequency"]
-            neighbor_dict[a].append((b, freq))
-            neighbor_dict[b].append((a, freq))
-        for cell in neighbor_dict:
-            neighbor_dict[cell].sort(key=lambda x: -x[1])
-        full_neighbor_map[file] = neighbor_dict
-
-    #Save for future runs
-    with open(cache_file, "wb") as f:
+        df = read_pair_file(os.path.join(input_dir, file))
+        full_neighbor_map[file] = build_neighbor_dict(df["Item 1"].to_numpy(), df["Item 2"].to_numpy(), df["Frequency"].to_numpy())
+
+    #Save for future runs; written under a temporary name, as several processes may build the same map
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
         pickle.dump(full_neighbor_map, f)
+    os.replace(tmp_file, cache_file)
+
+    return full_neighbor_map
+
+# Helper to add new cell pairs to an existing neighbor dict
+def patch_neighbor_dict(neighbor_dict, item1, item2, freq):
+    """
+    Adds pairs that are new to the chromosome (e.g. pairs of newly added cells, as returned by
+    createPairwiseSimilarities.addPairwiseSimilarities) to neighbor_dict in place. Only the lists of cells
+    in these pairs are touched. The result equals build_neighbor_dict on the CSV rows merged by
+    mergePairwiseSimilarities: lists stay sorted by descending frequency, existing entries first among ties.
+    """
+    item1, item2, freq = np.asarray(item1), np.asarray(item2), np.asarray(freq)
+    added = build_neighbor_dict(item1, item2, freq)
+    for cell, entries in added.items():
+        neighbor_dict[cell] = list(heapq.merge(neighbor_dict.get(cell, []), entries, key=lambda x: -x[1]))
+    return neighbor_dict
 
+def patch_neighbor_map_cache(input_dir, added_pairs):
+    """
+    Patches the cached neighbor map (full_neighbor_map.pkl) of input_dir with {csv filename: (item1, item2, frequency)}
+    arrays of new pairs. Without a cache nothing is done, build_full_neighbor_map reads the updated CSV files.
+    """
+    cache_file = os.path.join(input_dir, "full_neighbor_map.pkl")
+    if not os.path.exists(cache_file):
+        return None
+    with open(cache_file, "rb") as f:
+        full_neighbor_map = pickle.load(f)
+    for file, arrays in added_pairs.items():
+        if file in full_neighbor_map:
+            patch_neighbor_dict(full_neighbor_map[file], *arrays)
+        else:
+            # A file written in full; it replaces a cached entry of the same chromosome stored in another format
+            for stale in [key for key in full_neighbor_map if pair_file_stem(key) == pair_file_stem(file)]:
+                del full_neighbor_map[stale]
+            full_neighbor_map[file] = build_neighbor_dict(*arrays)
+    with open(cache_file, "wb") as f:
+        pickle.dump(full_neighbor_map, f)
     return full_neighbor_map
 
+# Helper to turn frequencies into edge weights
+def normalize_neighbor_weights(neighbor_dict, weight_norm=None):
+    """
+    Returns a copy of one chromosome's neighbor dict where each (neighbor, frequency) becomes (neighbor, weight),
+    keeping the neighbor order, so kNN edges are still chosen by frequency.
+    weight_norm:
+        None       - the weight is the frequency.
+        "coverage" - f_ij / sqrt(s_i * s_j), where s_i is the sum of cell i's frequencies on this chromosome.
+                     Cells with many contacts share many cliques with every cell; this removes that bias.
+    PageRank normalizes the out-weights of every node, so scaling all weights of a chromosome has no effect.
+    """
+    if weight_norm is None:
+        return neighbor_dict
+    if weight_norm != "coverage":
+        raise ValueError(f"Unknown weight normalization {weight_norm}")
+    coverage = {cell: sum(f for _, f in neighbors) for cell, neighbors in neighbor_dict.items()}
+    normalized = defaultdict(list)
+    for cell, neighbors in neighbor_dict.items():
+        normalized[cell] = [(n, f / math.sqrt(coverage[cell] * coverage[n])) for n, f in neighbors]
+    return normalized
+
+# Helper to build one chromosome's kNN graph among the active cells
+def build_knn_graph(neighbor_dict, active_cells, k=K, weighted=False):
+    """
+    Directed graph with an edge from every active cell to its top k active neighbors of neighbor_dict (one chromosome
+    of a neighbor map), weighted by their frequency if weighted. Views of packed neighbor maps that provide their own
+    knn_graph method (e.g. consensusSCHiCRank.CSRNeighborDict) build the same graph from their arrays.
+    """
+    if hasattr(neighbor_dict, "knn_graph"):
+        return neighbor_dict.knn_graph(active_cells, k, weighted)
+    G = nx.DiGraph()
+    for cell in active_cells:
+        neighbors = [(n, w) for n, w in neighbor_dict.get(cell, []) if n in active_cells][:k]
+        if weighted:
+            G.add_weighted_edges_from((cell, neighbor, w) for neighbor, w in neighbors)
+        else:
+            G.add_edges_from((cell, neighbor) for neighbor, _ in neighbors)
+    return G
+
+# Helper to aggregate pagerank scores of all cells at once
+def trimmed_pagerank_sums(scores, trim=2, min_count=10):
+    """
+    Aggregates a cells x chromosomes matrix of PageRank scores, where NaN marks chromosomes on which
+    a cell had no score. For cells with at least `min_count` scores the `trim` lowest and highest
+    values are dropped before summing; otherwise all scores are summed.
+    Returns an array with one trimmed sum per row.
+    """
+    counts = np.sum(~np.isnan(scores), axis=1)
+    sorted_scores = np.sort(scores, axis=1) # NaN values are sorted to the end of each row
+    lo = np.where(counts >= min_count, trim, 0)
+    hi = np.where(counts >= min_count, counts - trim, counts)
+    cols = np.arange(scores.shape[1])
+    keep = (cols >= lo[:, None]) & (cols < hi[:, None])
+    return np.where(keep, sorted_scores, 0.0).sum(axis=1)
+
+# Helper to find the elbow of a decreasing curve
+def find_elbow(values, S=1.0):
+    """
+    Array-native equivalent of `KneeLocator(range(len(values)), values, S=S, curve='convex', direction='decreasing').knee`
+    (kneed 0.8.6, offline mode, interp1d). Returns the index of the elbow in `values`, or None if there is none.
+    """
+    y = np.asarray(values, dtype=float)
+    n = len(y)
+    if n < 2 or y.max() == y.min():
+        return None
+    # interp1d evaluated at its own nodes: y[k-1] + (y[k] - y[k-1]) for k >= 1
+    y = np.concatenate([y[:1], (y[1:] - y[:-1]) + y[:-1]])
+    x = np.arange(n)
+    x_normalized = (x - x.min()) / (x.max() - x.min())
+    y_normalized = (y - y.min()) / (y.max() - y.min())
+    y_normalized = y_normalized.max() - y_normalized # convex decreasing curve to concave increasing
+    difference = y_normalized - x_normalized
+
+    # Local maxima and minima of the difference curve (argrelextrema with mode='clip')
+    left = np.concatenate([difference[:1], difference[:-1]])
+    right = np.concatenate([difference[1:], difference[-1:]])
+    maxima = np.flatnonzero((difference >= left) & (difference >= right))
+    minima = np.flatnonzero((difference <= left) & (difference <= right))
+    if not maxima.size:
+        return None
+    thresholds = difference[maxima] - S * np.abs(np.diff(x_normalized).mean())
+
+    # Walk from the first maximum; a point is checked against the threshold of the last maximum
+    # unless a minimum was passed since then (a point that is both counts as a minimum)
+    i = np.arange(maxima[0], n - 1)
+    last_max = np.searchsorted(maxima, i, side="right") - 1
+    last_min_pos = np.searchsorted(minima, i, side="right") - 1
+    last_min = np.where(last_min_pos >= 0, minima[np.maximum(last_min_pos, 0)], -1)
+    detected = (maxima[last_max] > last_min) & (difference[i + 1] < thresholds[last_max])
+    if not detected.any():
+        return None
+    return int(maxima[last_max[np.argmax(detected)]])
+
 # Main function
 
-def run_pagerank_filter(INPUT_DIR, label="test", plots=True):
+@instrumentation.timed("run_pagerank_filter")
+def run_pagerank_filter(INPUT_DIR=None, label="test", plots=True, neighbor_map=None, plot_dir=None, plot_format="png",
+                        k=K, cells=None, cell_phases=None, save=True, weighted=False, weight_norm=None, multiplicities=None):
     """
     Iteratively filters cells based on PageRank scores computed from cell k nearest neighbor graphs across chromosomes.
     This function builds directed graphs for each chromosome, where nodes represent cells and edges represent
@@ -100,100 +314,135 @@ def run_pagerank_filter(INPUT_DIR, label="test", plots=True):
         label (str, optional): Label used for output file naming. Default is "test".
         plots (bool, optional): Whether to generate and display plots of PageRank distributions and elbow points.
             Default is True.
+        neighbor_map (dict, optional): Neighbor map already held in memory, e.g. from `build_neighbor_map_from_arrays`.
+            If given, INPUT_DIR is not read. Default is None.
+        plot_dir (str, optional): If given together with plots=True, plots are not displayed but saved to this directory
+            by a background process (headless mode), so plotting does not slow down the filtering. Default is None.
+        plot_format (str, optional): File format of saved plots, e.g. "png" or "pdf". Default is "png".
+        k (int, optional): Number of top neighbors of each cell in the kNN graphs. Default is K.
+        cells (iterable, optional): Cell IDs to filter, e.g. the cells of some phases. Default is all cells.
+        cell_phases (list, optional): Phase of each cell ID. Default is read from metaFn.
+        save (bool, optional): Whether to save the result CSV. Default is True.
+        weighted (bool, optional): Whether kNN edges keep their frequency as weight for a weighted PageRank.
+            Default is False (every edge has weight 1).
+        weight_norm (str, optional): Per chromosome normalization of the weights, see normalize_neighbor_weights.
+            Implies weighted=True.
+        multiplicities (list, optional): How often each chromosome of the neighbor map counts in the aggregation,
+            e.g. for bootstrap samples drawn with replacement. Each chromosome is ranked once. Default is once each.
+    Returns:
+        pandas.DataFrame with columns Cell, Iteration, Score and Phase, as saved to the CSV file.
     Outputs:
         - Saves a CSV file listing all cells, the iteration in which they were deemed central,
           their final PageRank score, and their phase.
-        - Optionally displays plots of PageRank distributions and elbow points for up to three iterations at a time.
+        - Optionally displays plots of PageRank distributions and elbow points for up to three iterations at a time,
+          or saves them to plot_dir (including the last, possibly incomplete, batch).
     Notes:
-        - Requires global variables: `cell_phases`, `K`, `MIN_ACTIVE_CELLS`, and the functions
-          `build_full_neighbor_map`, `KneeLocator`, as well as the libraries `networkx`, `matplotlib.pyplot`, and `pandas`.
+        - Requires global variables: `MIN_ACTIVE_CELLS`, and the functions
+          `build_full_neighbor_map`, `trimmed_pagerank_sums`, `find_elbow`, as well as the libraries `networkx`, `matplotlib.pyplot`, and `pandas`.
         - The function assumes that all cells are initially active and iteratively deactivates cells with the lowest
           PageRank scores until the elbow point or a minimum threshold is reached.
     """
     
     resFn = f"final_active_cells_{label}.csv"
 
-    active_cells = set([j for j in range(len(cell_phases))]) #Initially all cells
+    if cell_phases is None:
+        cell_phases = load_cell_phases()
+    if cells is None:
+        active_cells = set([j for j in range(len(cell_phases))]) #Initially all cells
+    else:
+        active_cells = set(int(cell) for cell in cells)
     inactive_info = []
     iteration = 0
 
-    full_neighbor_map = build_full_neighbor_map(INPUT_DIR)
+    if neighbor_map is not None:
+        full_neighbor_map = neighbor_map
+    else:
+        full_neighbor_map = build_full_neighbor_map(INPUT_DIR)
+
+    weighted = weighted or weight_norm is not None
+    if weighted:
+        full_neighbor_map = {file: normalize_neighbor_weights(neighbor_dict, weight_norm) for file, neighbor_dict in full_neighbor_map.items()}
+
+    batch_plots = []
+    plot_writer = PlotWriter(plot_dir, fmt=plot_format) if plots and plot_dir is not None else None
 
     while True:
-        cell_pageranks = {cell: [] for cell in active_cells}
+        # Scores are held in a cells x chromosomes matrix, NaN where a cell is not in the chromosome's graph
+        active = np.array(sorted(active_cells), dtype=int)
+        position = np.full(active.max() + 1, -1, dtype=int)
+        position[active] = np.arange(len(active))
+        scores = np.full((len(active), len(full_neighbor_map)), np.nan)
+        graph_build_s = pagerank_s = 0.0
 
-        for file, neighbor_dict in full_neighbor_map.items():
+        for col, (file, neighbor_dict) in enumerate(full_neighbor_map.items()):
             #For each chromsome build a directed graph where each cell is a node and edges are the top K neighbours
-            G = nx.DiGraph()
-            for cell in active_cells:
-                neighbors = [n for n, _ in neighbor_dict.get(cell, []) if n in active_cells][:K]
-                for neighbor in neighbors:
-                    G.add_edge(cell, neighbor)
+            start = time.perf_counter()
+            G = build_knn_graph(neighbor_dict, active_cells, k, weighted)
+            graph_build_s += time.perf_counter() - start
 
             # Compute PageRank
+            start = time.perf_counter()
             pr = nx.pagerank(G)
-            for cell, score in pr.items():
-                cell_pageranks[cell].append(score)
+            if pr:
+                ranked = np.fromiter(pr.keys(), dtype=int, count=len(pr))
+                scores[position[ranked], col] = np.fromiter(pr.values(), dtype=float, count=len(pr))
+            pagerank_s += time.perf_counter() - start
 
-        # Process pagerank lists by removing top and bottom 2 values and assigning a mean pagerank to each cell
-        pagerank_sums = {}
-        for cell, ranks in cell_pageranks.items():
-            sorted_ranks = sorted(ranks)
-            trimmed = sorted_ranks[2:-2] if len(sorted_ranks) >= 10 else sorted_ranks
-            pagerank_sums[cell] = sum(trimmed)
+        # Remove top and bottom 2 values of each cell and sum the rest
+        start = time.perf_counter()
+        if multiplicities is not None:
+            scores = np.repeat(scores, multiplicities, axis=1)
+        pagerank_sums = trimmed_pagerank_sums(scores)
 
         # Sort by sum
-        sorted_cells = sorted(pagerank_sums.items(), key=lambda x: x[1], reverse=True)
-        values = [score for _, score in sorted_cells]
+        order = np.argsort(-pagerank_sums, kind="stable")
+        sorted_ids = active[order]
+        values = pagerank_sums[order]
+        aggregate_s = time.perf_counter() - start
 
         # Elbow detection
-        x = list(range(len(values)))
-        knee_locator = KneeLocator(x, values, curve='convex', direction='decreasing')
-        elbow_index = knee_locator.knee
+        start = time.perf_counter()
+        elbow_index = find_elbow(values)
+        elbow_s = time.perf_counter() - start
 
         # Optionally plot the progress
         if plots:
             # Save iteration data for batch plotting
-            if 'batch_plots' not in locals():
-                batch_plots = []
-            batch_plots.append((iteration+1, x, values, sorted_cells, elbow_index))
+            batch_plots.append((iteration+1, values, sorted_ids, elbow_index))
 
             if len(batch_plots) == 3:
-                fig, axes = plt.subplots(1, 3, figsize=(18, 5))
-                for ax, (it_num, x_vals, y_vals, scells, eidx) in zip(axes, batch_plots):
-                    phase_colors = {p: plt.cm.tab10(i % 10) for i, p in enumerate(sorted(set(cell_phases)))}
-                    cell_ids = [cell for cell, _ in scells]
-                    cell_colors = [phase_colors[cell_phases[cell]] for cell in cell_ids]
-                    ax.scatter(x_vals, y_vals, c=cell_colors, s=10)
-                    if eidx is not None:
-                        ax.axvline(x=eidx, color='red', linestyle='--', label=f'Elkonis pēc {eidx} šūnām')
-                    ax.set_title(f"Iterācija {it_num}", fontsize=20)
-                    ax.set_xlabel("Šūnas sakārtotas pēc Pagerank", fontsize=18)
-                    ax.set_ylabel("PageRank vērtība", fontsize=18)
-                handles = [plt.Line2D([0], [0], marker='o', color='w', label=phase,
-                                    markerfacecolor=color, markersize=6)
-                        for phase, color in phase_colors.items()]
-                fig.legend(handles=handles, title="Šūnu fāzes", loc='upper right', fontsize='large', title_fontsize='x-large')
-                plt.tight_layout()
-                plt.show()
+                if plot_writer is not None:
+                    plot_writer.submit(render_iteration_batch, f"{label}-iterations-{batch_plots[0][0]}-{batch_plots[-1][0]}", batch_plots, cell_phases)
+                else:
+                    fig, axes = plt.subplots(1, 3, figsize=(18, 5))
+                    draw_iteration_batch(fig, axes, batch_plots, cell_phases)
+                    plt.show()
                 batch_plots = []
 
         # If no cell before elbow, finish... could be changed in future to e.g. change k
-        if elbow_index is None or len(active_cells) <= MIN_ACTIVE_CELLS or elbow_index == len(values) or elbow_index == 0:
+        finished = elbow_index is None or len(active_cells) <= MIN_ACTIVE_CELLS or elbow_index == len(values) or elbow_index == 0
+        instrumentation.event("run_pagerank_filter.iteration", label=label, iteration=iteration, active_cells=len(active_cells),
+                              graph_build_s=graph_build_s, pagerank_s=pagerank_s, aggregate_s=aggregate_s, elbow_s=elbow_s,
+                              elbow_index=elbow_index, cells_removed=0 if finished else elbow_index)
+        if finished:
             break
 
         # Mark cells to deactivate (those on the left of the elbow)
-        newly_inactive = sorted_cells[:elbow_index]
-        for cell, score in newly_inactive:
+        for cell, score in zip(sorted_ids[:elbow_index].tolist(), values[:elbow_index].tolist()):
             phase = cell_phases[cell] if cell < len(cell_phases) else "Unknown"
             inactive_info.append([cell, iteration, score, phase])
 
         # Update active set (cells to the right of elbow remain active)
-        active_cells = set(cell for cell, _ in sorted_cells[elbow_index:])
+        active_cells = set(sorted_ids[elbow_index:].tolist())
 
         iteration += 1
         print(f"{label} Iteration {iteration}: {len(active_cells)} active cells, elbow at {elbow_index}")
 
+    if plot_writer is not None:
+        if batch_plots:
+            plot_writer.submit(render_iteration_batch, f"{label}-iterations-{batch_plots[0][0]}-{batch_plots[-1][0]}", batch_plots, cell_phases)
+        plot_writer.close()
+
     # Append final active cells to inactive_info
     for cell in sorted(active_cells):
         phase = cell_phases[cell] if cell < len(cell_phases) else "Unknown"
@@ -201,8 +450,10 @@ def run_pagerank_filter(INPUT_DIR, label="test", plots=True):
 
     # Save inactive cells
     inactive_df = pd.DataFrame(inactive_info, columns=["Cell", "Iteration", "Score", "Phase"])
-    inactive_df.to_csv(resFn, index=False)
-    print(f"Inactive cells saved to {resFn}")
+    if save:
+        inactive_df.to_csv(resFn, index=False)
+        print(f"Inactive cells saved to {resFn}")
+    return inactive_df
 
 
 if __name__ == "__main__":